@@ -0,0 +1,100 @@
+# Compression ratio against encode/decode speed of the tile archive codecs (tile_codecs.py).
+#
+# Usage: python bench_codecs.py --npz /path/to/npz/scene.npz --codecs none zlib:1 zlib:6 lz4 zstd:1 zstd:3 --threads 1 8
+#
+# Each archive given with --npz is re-saved with every codec and thread count, then read back
+# whole and tile by tile in random order. Without --npz a synthetic scene from bench_tiling.py
+# is tiled first, but ratios on real imagery are the ones to go by.
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from tile_codecs import lz4, zstandard
+from tile_store import load_tiles, migrate
+
+# lz4 and zstd are only compared when their packages are installed
+DEFAULT_CODECS = ['none', 'zlib:1', 'zlib:6'] + (['lz4'] if lz4 else []) + \
+    (['zstd:1', 'zstd:3', 'zstd:9'] if zstandard else [])
+
+
+def synthetic_archive(work_dir, size, water_fraction):
+    # a tile archive of a generated scene, for when no real archive is at hand
+    import rasterio
+    import bench_tiling
+    import filter as rgb_filter
+    from tile_store import save_tiles
+    tif_path = os.path.join(work_dir, 'synthetic.tif')
+    npz_path = os.path.join(work_dir, 'synthetic.npz')
+    bench_tiling.make_scene(tif_path, size, water_fraction=water_fraction)
+    with rasterio.open(tif_path) as src:
+        save_tiles(npz_path, src, 'synthetic.tif', rgb_filter.tile_scene(src))
+    return npz_path
+
+
+def bench_codec(npz_path, codec, threads, work_dir, seed=0):
+    out_path = os.path.join(work_dir, 'codec.npz')
+    raw = np.asarray(load_tiles(npz_path)['data'])
+    start = time.perf_counter()
+    migrate(npz_path, out_path, codec, threads)
+    encode = time.perf_counter() - start
+
+    store = load_tiles(out_path)
+    start = time.perf_counter()
+    decoded = np.asarray(store['data'])
+    decode = time.perf_counter() - start
+    assert np.array_equal(decoded, raw), f'{codec} did not round-trip'
+
+    order = np.random.default_rng(seed).permutation(len(raw))
+    start = time.perf_counter()
+    for k in order.tolist():
+        store['data'][k].sum()
+    random_access = time.perf_counter() - start
+
+    mb = raw.nbytes / 1e6
+    return {'codec': codec, 'threads': threads, 'tiles': len(raw), 'raw_mb': mb,
+            'file_mb': os.path.getsize(out_path) / 1e6,
+            'ratio': raw.nbytes / os.path.getsize(out_path),
+            'encode_mb_s': mb / encode, 'decode_mb_s': mb / decode,
+            'random_tiles_s': len(raw) / random_access if random_access > 0 else None}
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='bench_codecs_')
+    try:
+        archives = args.npz or [synthetic_archive(work_dir, args.size, args.water_fraction)]
+        results = []
+        print(f"{'archive':>20} {'codec':>8} {'threads':>7} {'tiles':>6} {'ratio':>6} {'encode MB/s':>12} "
+              f"{'decode MB/s':>12} {'tiles/s random':>15}")
+        for npz_path in archives:
+            for codec in args.codecs:
+                for threads in args.threads:
+                    r = bench_codec(npz_path, codec, threads, work_dir)
+                    r['archive'] = os.path.basename(npz_path)
+                    results.append(r)
+                    print(f"{r['archive'][-20:]:>20} {codec:>8} {threads:>7} {r['tiles']:>6} {r['ratio']:>6.2f} "
+                          f"{r['encode_mb_s']:>12.1f} {r['decode_mb_s']:>12.1f} {r['random_tiles_s'] or 0:>15.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--npz', type=str, nargs='+', default=None, help='tile archives to benchmark on')
+    parser.add_argument('--codecs', type=str, nargs='+', default=DEFAULT_CODECS, help='codec specs to compare')
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                        help='compression thread counts to compare')
+    parser.add_argument('--size', type=int, default=3000, help='size of the synthetic scene when no --npz is given')
+    parser.add_argument('--water_fraction', type=float, default=0.2, help='water share of the synthetic scene')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+    main(args)
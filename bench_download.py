@@ -0,0 +1,95 @@
+# End-to-end benchmark of the usgs-download.py pipeline (search, request, poll, download)
+# against the local mock_m2m.py server, for several concurrency settings.
+#
+# Usage: python bench_download.py --workers 1 4 16 --scenes 64 --file_size 20000000 --bandwidth 10
+#
+# By default a fresh mock server runs inside this process for every setting. For numbers that
+# are not skewed by the server sharing the GIL, start `python mock_m2m.py ...` separately and
+# pass its url with --service_url.
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import mock_m2m
+
+usgs_download = importlib.import_module('usgs-download')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_once(service_url, workers, output_dir, poll_interval):
+    usgs_download.failure_download.clear()
+    usgs_download.transfer_log.clear()
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        usgs_download.main(['-u', 'bench', '-p', 'bench', '-o', output_dir, '--service_url', service_url,
+                            '-w', str(workers), '--poll_interval', str(poll_interval)])
+    elapsed = time.time() - start
+
+    log = list(usgs_download.transfer_log)
+    total_bytes = sum(nbytes for _, nbytes, _, _ in log)
+    ttfb = [t for _, _, t, _ in log if t is not None]
+    return {'workers': workers,
+            'files': len(log),
+            'failed': len(usgs_download.failure_download),
+            'seconds': elapsed,
+            'files_per_s': len(log) / elapsed,
+            'mb_per_s': total_bytes / 1e6 / elapsed,
+            'ttfb_median': percentile(ttfb, 0.5),
+            'ttfb_p95': percentile(ttfb, 0.95)}
+
+
+def main(args):
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='bench_download_')
+    results = []
+    print(f"{'workers':>8} {'files':>6} {'failed':>6} {'seconds':>8} {'files/s':>8} {'MB/s':>8} "
+          f"{'ttfb p50':>9} {'ttfb p95':>9}")
+    for workers in args.workers:
+        server = None
+        service_url = args.service_url
+        if service_url is None:
+            server, service_url = mock_m2m.start_server(**mock_m2m.config_from_args(args))
+        try:
+            result = run_once(service_url, workers, os.path.join(output_dir, f'w{workers}'), args.poll_interval)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        results.append(result)
+        print(f"{result['workers']:>8} {result['files']:>6} {result['failed']:>6} {result['seconds']:>8.2f} "
+              f"{result['files_per_s']:>8.2f} {result['mb_per_s']:>8.2f} "
+              f"{result['ttfb_median'] or 0:>9.4f} {result['ttfb_p95'] or 0:>9.4f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.output_dir is None:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help='concurrency settings to compare')
+    parser.add_argument('--service_url', type=str, default=None, help='use an already running mock server')
+    parser.add_argument('--output_dir', type=str, default=None, help='where to download (default: temp dir)')
+    parser.add_argument('--poll_interval', type=float, default=0.5, help='shortest download-retrieve wait')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this json file')
+    mock_m2m.add_config_arguments(parser)
+    args = parser.parse_args()
+    main(args)
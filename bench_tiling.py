@@ -0,0 +1,239 @@
+# Benchmark of the tiling steps of filter.py and filter_greyscale.py on synthetic scenes.
+#
+# Usage: python bench_tiling.py --size 5000 --block 512 --water_fraction 0.05 --repeat 3 --baseline bench_tiling.json
+#
+# Every run generates 4-band GeoTIFFs with horizontal "rivers" (green > NIR, so NDWI marks them
+# as water) and a centerline shapefile running along each river, laid out like
+# filter_greyscale.py's --centerline_dir. Each step is timed separately (best of --repeat)
+# together with the peak memory it allocated (tracemalloc, which sees numpy buffers but not
+# GDAL's block cache). With --baseline, the step times are compared to a stored run and the
+# script exits with status 1 when one is slower than --tolerance allows; --save_baseline
+# writes the current run there instead.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+
+import filter as rgb_filter
+import filter_greyscale as greyscale_filter
+import metrics
+from tile_store import save_tiles
+from tiling import select_tiles
+
+AREA = 'synthetic'
+PIXEL_SIZE = 0.5
+
+
+def make_scene(path, size, block=512, water_fraction=0.05, river_height=64, seed=0):
+    """
+    Write a synthetic 4-band uint8 GeoTIFF of size x size pixels, block by block.
+
+    :param block: Internal tile size, 0 writes a striped (untiled) file like many USGS orthos
+    :param water_fraction: Share of the rows covered by rivers
+    :return: List of (first row, last row + 1) of every river
+    """
+    rng = np.random.default_rng(seed)
+    n_rivers = max(1, int(round(size * water_fraction / river_height))) if water_fraction > 0 else 0
+    starts = np.sort(rng.choice(max(1, size - river_height), size=n_rivers, replace=False)) if n_rivers else []
+    rivers = [(int(r), int(r) + river_height) for r in starts]
+    water = np.zeros(size, dtype=bool)
+    for r0, r1 in rivers:
+        water[r0:r1] = True
+
+    profile = dict(driver='GTiff', height=size, width=size, count=4, dtype='uint8', crs='EPSG:26916',
+                   transform=from_origin(500000, 4400000, PIXEL_SIZE, PIXEL_SIZE))
+    if block:
+        profile.update(tiled=True, blockxsize=block, blockysize=block)
+    step = block or 256
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row in range(0, size, step):
+            rows = min(step, size - row)
+            # land: NIR brighter than green, noisy so compression has something to do
+            data = rng.integers(40, 120, size=(4, rows, size), dtype=np.uint8)
+            data[3] += 80
+            wet = water[row:row + rows]
+            data[1, wet] += 100
+            data[3, wet] -= 100
+            dst.write(data, window=rasterio.windows.Window(0, row, size, rows))
+    return rivers
+
+
+def make_centerlines(shp_path, tif_path, rivers):
+    """Write a shapefile with one line along the middle row of every river."""
+    with rasterio.open(tif_path) as src:
+        left, bottom, right, top = src.bounds
+        transform = src.transform
+    lines = []
+    for r0, r1 in rivers:
+        _, y = transform * (0, (r0 + r1) / 2)
+        lines.append(LineString([(left, y), (right, y)]))
+    os.makedirs(os.path.dirname(shp_path), exist_ok=True)
+    gpd.GeoDataFrame({'id': list(range(len(lines)))}, geometry=lines, crs='EPSG:26916').to_file(shp_path)
+
+
+def time_step(func, repeat=1):
+    """
+    Best wall time of func() over repeat runs, the largest tracemalloc peak, and the last result.
+    """
+    best = None
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        result = None
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak, result
+
+
+def bench_scene(tif_path, shp_path, work_dir, repeat=1):
+    """
+    Time every tiling step on one scene.
+
+    :return: Dict of step name -> {'seconds', 'peak_mb', ...}
+    """
+    steps = {}
+
+    def record(name, func, **extra):
+        seconds, peak, result = time_step(func, repeat)
+        steps[name] = dict(seconds=seconds, peak_mb=peak / 2 ** 20, **extra)
+        return result
+
+    filename = os.path.basename(tif_path)
+    with rasterio.open(tif_path) as src:
+        ndwi = record('NDWI', lambda: rgb_filter.NDWI(src))
+        rows, cols = select_tiles(ndwi, min_sum=100)
+        results = record('sliding_crop', lambda: rgb_filter.sliding_crop(src, ndwi), tiles=len(rows))
+        record('crop_to_npz', lambda: [rgb_filter.crop_to_npz(src, i_c, j_c)
+                                       for i_c, j_c in zip(rows.tolist(), cols.tolist())], tiles=len(rows))
+        record('tile_scene', lambda: rgb_filter.tile_scene(src), tiles=len(rows))
+        record('tile_scene_strip', lambda: rgb_filter.tile_scene(src, strip=True), tiles=len(rows))
+
+        legacy_path = os.path.join(work_dir, 'legacy.npz')
+        record('savez_compressed', lambda: np.savez_compressed(
+            legacy_path, accumulated_results=results, a=src.transform.a, b=src.transform.b,
+            d=src.transform.d, e=src.transform.e, count=src.count, filename=filename))
+        steps['savez_compressed']['mb'] = os.path.getsize(legacy_path) / 1e6
+        npz_path = os.path.join(work_dir, 'columnar.npz')
+        record('save_tiles', lambda: save_tiles(npz_path, src, filename, results))
+        steps['save_tiles']['mb'] = os.path.getsize(npz_path) / 1e6
+
+        tif_dir = os.path.join(work_dir, 'tifs')
+
+        def load():
+            shutil.rmtree(tif_dir, ignore_errors=True)
+            os.makedirs(tif_dir)
+            rgb_filter.load_tif_from_np(npz_path, tif_dir)
+        record('load_tif_from_np', load, tiles=len(rows))
+
+        def load_mask():
+            # cleared on every repeat, so each one times a cold read of the shapefile
+            greyscale_filter.read_centerlines.cache_clear()
+            return greyscale_filter.load_mask(shp_path, src)
+        centerline = record('load_mask', load_mask)
+        grey_rows, _ = select_tiles(centerline, min_sum=0, pad=256)
+        record('greyscale_sliding_crop', lambda: greyscale_filter.sliding_crop(src, centerline),
+               tiles=len(grey_rows))
+        record('greyscale_tile_scene', lambda: greyscale_filter.tile_scene(src, centerline), tiles=len(grey_rows))
+    return steps
+
+
+def compare(steps, baseline, tolerance):
+    """
+    Steps that got slower than baseline by more than tolerance (0.2 = 20 %).
+
+    :return: List of (step, baseline seconds, current seconds)
+    """
+    regressions = []
+    for name, step in steps.items():
+        if name in baseline and step['seconds'] > baseline[name]['seconds'] * (1 + tolerance):
+            regressions.append((name, baseline[name]['seconds'], step['seconds']))
+    return regressions
+
+
+def main(args):
+    work_dir = args.output_dir or tempfile.mkdtemp(prefix='bench_tiling_')
+    os.makedirs(work_dir, exist_ok=True)
+    tif_path = os.path.join(work_dir, f'{AREA}_{args.size}.tif')
+    centerline_dir = os.path.join(work_dir, 'centerlines')
+    shp_path = os.path.join(centerline_dir, AREA, AREA + '.shp')
+
+    start = time.time()
+    rivers = make_scene(tif_path, args.size, args.block, args.water_fraction, seed=args.seed)
+    make_centerlines(shp_path, tif_path, rivers)
+    print(f'generated {args.size}x{args.size} scene with {len(rivers)} rivers in {time.time() - start:.1f} s')
+    # the generated layout is what filter_greyscale.py --centerline_dir expects
+    assert greyscale_filter.find_shp(os.path.basename(tif_path), centerline_dir) == shp_path
+
+    steps = bench_scene(tif_path, shp_path, work_dir, args.repeat)
+    run = {'config': {'size': args.size, 'block': args.block, 'water_fraction': args.water_fraction,
+                      'repeat': args.repeat, 'seed': args.seed},
+           'peak_rss_mb': metrics.peak_rss_mb(), 'steps': steps}
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != run['config']:
+            print(f'baseline was recorded with {baseline["config"]}, comparing anyway')
+
+    print(f"{'step':>24} {'seconds':>9} {'peak MB':>8} {'tiles':>6} {'tiles/s':>9} {'baseline':>9} {'change':>7}")
+    for name, step in steps.items():
+        tiles = step.get('tiles')
+        rate = tiles / step['seconds'] if tiles and step['seconds'] > 0 else None
+        base = baseline['steps'][name]['seconds'] if baseline and name in baseline['steps'] else None
+        tiles = '' if tiles is None else tiles
+        rate = '' if rate is None else f'{rate:.1f}'
+        change = f"{(step['seconds'] / base - 1) * 100:+.0f}%" if base else ''
+        base = '' if base is None else f'{base:.3f}'
+        print(f"{name:>24} {step['seconds']:>9.3f} {step['peak_mb']:>8.1f} {tiles:>6} {rate:>9} {base:>9} {change:>7}")
+    print(f"process peak RSS {run['peak_rss_mb']:.0f} MB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+    if args.output_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = compare(steps, baseline['steps'], args.tolerance) if baseline else []
+    for name, before, after in regressions:
+        print(f'REGRESSION {name}: {before:.3f} s -> {after:.3f} s')
+    return run, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=5000, help='width and height of the synthetic scene')
+    parser.add_argument('--block', type=int, default=512, help='internal tile size of the tif, 0 for a striped tif')
+    parser.add_argument('--water_fraction', type=float, default=0.05, help='share of the scene covered by rivers')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic scene')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per step, the fastest one is reported')
+    parser.add_argument('--baseline', type=str, default=None, help='json of an earlier run to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='write this run to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--output_dir', type=str, default=None, help='keep the generated files here (default: temp dir)')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this json file')
+    args = parser.parse_args()
+    if args.save_baseline and not args.baseline:
+        parser.error('--save_baseline needs --baseline')
+    _, regressions = main(args)
+    sys.exit(1 if regressions else 0)
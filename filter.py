@@ -1,16 +1,61 @@
 import rasterio
 import numpy as np
 import os
-from tqdm import tqdm
 import time
 from rasterio.windows import Window
 import argparse
+from fractions import Fraction
+from functools import partial
+from tile_store import save_tiles, load_tiles, tile_records, add_codec_arguments, TILE_FORMAT_VERSION
+from tiling_manifest import TilingManifest, incremental_scenes, MANIFEST_NAME
+import metrics
+from rasterio.enums import Resampling
+import work_queue
+from tiling import run_scenes, run_scene_queue, list_scenes, block_strips, select_tiles, tile_starts, tile_record, \
+    coarse_candidates, scene_size, atomic_write
 
-def NDWI(src):
-    r,g,b,nir = src.read()
-    ndwi = (g / 255. - nir / 255.) / (g / 255. + nir / 255.)
-    # ndvi = (nir / 255. - r / 255.) / (nir / 255. + r / 255.)
-    return np.where(ndwi > 0.1, 1, 0)
+def water_mask(g, nir, threshold=0.1, out=None):
+    """
+    NDWI water mask from green and NIR arrays.
+
+    (g - nir) / (g + nir) > threshold is evaluated as (1 - t) * g > (1 + t) * nir with t written
+    as a fraction, i.e. 9 * g > 11 * nir for the default 0.1. This needs no division or /255
+    scaling, is False where g + nir == 0, and runs in int32 on integer imagery.
+
+    :param g: Green band
+    :param nir: NIR band, same shape as g
+    :param threshold: NDWI value above which a pixel counts as water
+    :param out: Optional uint8 array to write the mask into
+    :return: uint8 array shaped like g, 1 for water and 0 otherwise
+    """
+    t = Fraction(threshold).limit_denominator(1000)
+    lhs, rhs = t.denominator - t.numerator, t.denominator + t.numerator
+    work_dtype = np.float32 if np.issubdtype(g.dtype, np.floating) else np.int32
+    if out is None:
+        out = np.empty(g.shape, dtype=np.uint8)
+    g = g.astype(work_dtype)
+    g *= lhs
+    nir = nir.astype(work_dtype)
+    nir *= rhs
+    np.greater(g, nir, out=out.view(np.bool_))
+    # ndvi = (nir - r) / (nir + r)
+    return out
+
+def NDWI(src, threshold=0.1):
+    """
+    Water mask of a whole scene from the green (band 2) and NIR (band 4) bands.
+
+    Only those two bands are read, in strips aligned to the raster's blocks, so the peak memory
+    is the uint8 mask plus one strip.
+
+    :param src: Open rasterio dataset with at least 4 bands
+    :return: uint8 array of shape (height, width), 1 for water and 0 otherwise
+    """
+    mask = np.empty((src.height, src.width), dtype=np.uint8)
+    for window in block_strips(src):
+        g, nir = src.read((2, 4), window=window)
+        water_mask(g, nir, threshold, out=mask[window.row_off:window.row_off + window.height])
+    return mask
 
 # crop and save to tif directly
 def crop(src, i_c, j_c,crop_tif_path, s_path = None, h=512,w=512):
@@ -33,22 +78,11 @@ def crop(src, i_c, j_c,crop_tif_path, s_path = None, h=512,w=512):
                         
     #makeup_mask(transform,crop_tif_path, s_path,h,w)
 
-# crop and later save to one np file for each 5000*5000 tif                        
+# crop and later save to one np file for each 5000*5000 tif
 def crop_to_npz(src, i_c, j_c, h=512, w=512):
-    # Compute the top left geographic (x, y) coordinates of the cropped TIFF
-    x_offset, y_offset = src.xy(i_c, j_c)
-    
     # Read the cropped data from the source
-    cropped_data = src.read(window=Window(j_c, i_c, h, w))
-
-    # Save cropped data, transform, and CRS to a NumPy (NPZ) file
-    #np.savez(npz_path, data=cropped_data, transform=transform, crs=src.crs)
-    return {
-            'data': cropped_data,
-            'crs': src.crs,
-            'x_offset': x_offset,
-            'y_offset': y_offset
-    }
+    cropped_data = src.read(window=Window(j_c, i_c, w, h))
+    return tile_record(src, i_c, j_c, cropped_data)
 
 def check_ndwi_sum(ndwi, i_c, j_c, h=512, w=512):
     """
@@ -73,30 +107,98 @@ def check_ndwi_sum(ndwi, i_c, j_c, h=512, w=512):
     
 
 def sliding_crop(src, ndwi, h=512, w=512):
-    tif = src.read()
-    _,tif_h,tif_w=tif.shape
-    x_start,y_start=0,0
-    x_end, y_end = 0,0
+    # keep the tiles whose NDWI sum over the tile is greater than 100 (see check_ndwi_sum)
+    rows, cols = select_tiles(ndwi, h, w, min_sum=100)
+    results = []
+    for i_c, j_c in zip(rows.tolist(), cols.tolist()):
+        metadata = crop_to_npz(src, i_c, j_c)
+        results.append(metadata)
+    return results
+
+def _block_reduce(a, factor, reduce):
+    # reduce every factor x factor block of a 2-d array, edge blocks may be partial
+    h, w = a.shape
+    fill = a.max() if reduce is np.minimum else a.min()
+    padded = np.full((-(-h // factor) * factor, -(-w // factor) * factor), fill, dtype=a.dtype)
+    padded[:h, :w] = a
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return reduce.reduce(reduce.reduce(blocks, axis=3), axis=1)
+
+def prescreen_tiles(src, factor=8, h=512, w=512, threshold=0.1, margin=0.05, overviews=False):
+    """
+    Candidate water tiles from a 1/factor resolution pass over the green and NIR bands.
+
+    Only bands 2 and 4 are read, strip by strip, and reduced to the per-block max of green and
+    min of NIR, so a block passes whenever any pixel in it does and no water tile can be missed.
+    Only the returned tiles need all bands decoded at full resolution.
+
+    With overviews=True and a file that has overviews, the two bands are instead read decimated
+    (GDAL picks the closest overview) with the NDWI threshold lowered by margin. This is lossy:
+    averaging can hide thin or sparse water, whose tiles are then dropped.
+
+    :param src: Open rasterio dataset with at least 4 bands
+    :param factor: Decimation factor of the coarse pass
+    :param margin: How much the NDWI threshold is lowered when overviews are used
+    :param overviews: Read the coarse pass from the file's overviews when it has them
+    :return: Tuple of two 1-d int arrays (rows, cols) of the candidate tiles
+    """
+    coarse_shape = (-(-src.height // factor), -(-src.width // factor))
+    if overviews and src.overviews(2) and src.overviews(4):
+        g, nir = src.read((2, 4), out_shape=(2,) + coarse_shape, resampling=Resampling.average)
+        coarse = water_mask(g, nir, threshold - margin)
+    else:
+        coarse = np.empty(coarse_shape, dtype=np.uint8)
+        step = factor * max(1, -(-256 // factor))
+        for row in range(0, src.height, step):
+            g, nir = src.read((2, 4), window=Window(0, row, src.width, min(step, src.height - row)))
+            water_mask(_block_reduce(g, factor, np.maximum), _block_reduce(nir, factor, np.minimum), threshold,
+                       out=coarse[row // factor:(row + len(g) + factor - 1) // factor])
+    return coarse_candidates(coarse, src.height, src.width, h, w, min_sum=100)
+
+def tile_scene(src, h=512, w=512, strip=False, prescreen=0, prescreen_overviews=False):
+    """
+    Crop the water tiles of a scene, reading its pixels only once.
+
+    NDWI, tile selection and cropping all work on the same buffer: the whole scene, whose kept
+    tiles are returned as views, or with strip=True one strip of tile height at a time, with
+    the kept tiles copied out so memory stays bounded for scenes larger than RAM.
+
+    With prescreen=F, a 1/F resolution pass (see prescreen_tiles) picks the candidate tiles
+    first, and only those are read at full resolution and tested exactly.
+
+    :return: List of tile_record dicts, same as sliding_crop(src, NDWI(src))
+    """
     results = []
-    while (y_end < tif_h):
-        y_end = y_start + h
-        if y_end > tif_h:
-            y_start = tif_h - h
-            if y_start < 0: break
-            y_end = tif_h + 1
-        x_start,x_end = 0,0
-        while (x_end < tif_w):
-            x_end = x_start + w
-            if x_end > tif_w: 
-                x_start = tif_w - w
-                if x_start < 0: break
-                x_end = tif_w + 1
-            if check_ndwi_sum(ndwi,y_start,x_start,h,w):
-                metadata = crop_to_npz(src, y_start, x_start)
-                results.append(metadata)
-                
-            x_start = x_end
-        y_start = y_end
+    if prescreen:
+        with metrics.stage('prescreen'):
+            rows, cols = prescreen_tiles(src, prescreen, h, w, overviews=prescreen_overviews)
+        for i_c, j_c in zip(rows.tolist(), cols.tolist()):
+            data = src.read(window=Window(j_c, i_c, w, h))
+            score = int(water_mask(data[1], data[3]).sum(dtype=np.int64))
+            if score > 100:
+                results.append(tile_record(src, i_c, j_c, data, score))
+        return results
+
+    if not strip:
+        with metrics.stage('read') as m:
+            data = src.read()
+            m['bytes_out'] = data.nbytes
+        with metrics.stage('ndwi'):
+            ndwi = np.empty(data.shape[1:], dtype=np.uint8)
+            for row in range(0, data.shape[1], h):
+                water_mask(data[1, row:row + h], data[3, row:row + h], out=ndwi[row:row + h])
+        with metrics.stage('select') as m:
+            rows, cols, scores = select_tiles(ndwi, h, w, min_sum=100, return_scores=True)
+            m['tiles'] = len(rows)
+        for i_c, j_c, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            results.append(tile_record(src, i_c, j_c, data[:, i_c:i_c + h, j_c:j_c + w], score))
+        return results
+
+    for i_c in tile_starts(src.height, h).tolist():
+        data = src.read(window=Window(0, i_c, src.width, h))
+        _, cols, scores = select_tiles(water_mask(data[1], data[3]), h, w, min_sum=100, return_scores=True)
+        for j_c, score in zip(cols.tolist(), scores.tolist()):
+            results.append(tile_record(src, i_c, j_c, data[:, :, j_c:j_c + w].copy(), score))
     return results
 
 def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filename):
@@ -108,7 +210,7 @@ def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filen
     - base_tiff_path: Base path for saving TIFF files.
     """
     data = cropping_results['data']
-    tiff_name = f"{str(filename)[:-4]}_crop_{cropping_results['x_offset']}_{cropping_results['y_offset']}.tif"
+    tiff_name = f"{os.path.splitext(str(filename))[0]}_crop_{cropping_results['x_offset']}_{cropping_results['y_offset']}.tif"
     tiff_path = os.path.join(base_tiff_path, tiff_name)
     trans = rasterio.Affine(a, b, cropping_results['x_offset'],
                             d, e, cropping_results['y_offset'])
@@ -120,47 +222,109 @@ def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filen
         dst.write(data)
 
 def load_tif_from_np(npz_path,base_tiff_path):
-    with np.load(npz_path, allow_pickle=True) as npz:
-        results = {key: npz[key] for key in npz.files}
-
-        a = results['a']
-        b = results['b']
-        d = results['d']
-        e = results['e']
-        count = results['count']
-        filename = results['filename']
-        for r in results['accumulated_results']:
-            save_npz_crops_to_tiffs(r,base_tiff_path,a,b,d,e,count,filename)
+    # reads both the columnar layout and the old pickled accumulated_results layout
+    store = load_tiles(npz_path)
+    a, b, _, d, e, _ = store['transform']
+    for r in tile_records(store):
+        save_npz_crops_to_tiffs(r,base_tiff_path,a,b,d,e,store['count'],store['filename'])
+
+def process_scene(filename, path, npz_path, strip=False, legacy_npz=False, prescreen=0, prescreen_overviews=False,
+                  codec='none', codec_threads=None):
+    with metrics.stage('scene', scene=filename) as scene_metrics, rasterio.open(path) as src:
+        scene_metrics['bytes_in'] = scene_size(path)
+        src_name = os.path.splitext(filename)[0] + '.npz'
+        with metrics.stage('tile', scene=filename) as m:
+            results = tile_scene(src, h=512, w=512, strip=strip, prescreen=prescreen,
+                                 prescreen_overviews=prescreen_overviews)
+            m['tiles'] = len(results)
+        npz_file = os.path.join(npz_path, src_name)
+        with metrics.stage('save', scene=filename) as m:
+            # written under a temporary name and renamed, so a crash never leaves a truncated npz
+            with atomic_write(npz_file) as f:
+                if legacy_npz:
+                    np.savez_compressed(f, accumulated_results=results,\
+                                        a=src.transform.a, b=src.transform.b,\
+                                        d=src.transform.d, e=src.transform.e,\
+                                            count=src.count, filename=filename)
+                else:
+                    save_tiles(f, src, filename, results, codec=codec, threads=codec_threads)
+            m['bytes_out'] = os.path.getsize(npz_file)
+        scene_metrics['tiles'] = len(results)
+        scene_metrics['bytes_out'] = m['bytes_out']
+    return len(results)
+
+def tiling_params(args):
+    # everything that changes the contents of a scene's npz, see --incremental
+    return {'h': 512, 'w': 512, 'ndwi_threshold': 0.1, 'min_sum': 100, 'prescreen': args.prescreen,
+            'prescreen_overviews': args.prescreen_overviews, 'legacy_npz': args.legacy_npz, 'codec': args.codec, 'format_version': TILE_FORMAT_VERSION}
+
+def add_tiling_arguments(parser):
+    # the options of process_scene, shared with pipeline.py
+    parser.add_argument('--strip', action='store_true', help='read each scene in strips of tile height to bound memory')
+    parser.add_argument('--prescreen', type=int, default=0,
+                        help='decimation factor of a coarse NDWI pass that skips dry tiles (0 = off)')
+    parser.add_argument('--prescreen_overviews', action='store_true',
+                        help='with --prescreen, read the coarse pass from the tif overviews; faster but lossy, '
+                             'thin or sparse water can be missed')
+    add_codec_arguments(parser)
+    parser.add_argument('--legacy_npz', action='store_true', help='write the old pickled accumulated_results layout')
+    parser.add_argument('--gdal_cache_mb', type=int, default=256, help='GDAL block cache of each worker process')
 
 def main(args):
     input_dir = args.input_dir
     npz_path = args.np_dir
-    for filename in tqdm(os.listdir(input_dir)):
-        tmp = os.path.join(input_dir,filename)
-        with rasterio.open(tmp) as src:
-            ndwi = NDWI(src)
-            src_name = filename[:-4] + '.npz'
-            results = sliding_crop(src,ndwi, h=512,w=512)
-            npz_file = os.path.join(npz_path, src_name)
-            np.savez_compressed(npz_file, accumulated_results=results,\
-                                a=src.transform.a, b=src.transform.b,\
-                                d=src.transform.d, e=src.transform.e,\
-                                    count=src.count, filename=filename)
+    # before any work unit is claimed, so a missing directory cannot fail (and use up) them
+    os.makedirs(npz_path, exist_ok=True)
+    scenes = list_scenes(input_dir)
+    on_done = None
+    if args.incremental:
+        manifest = TilingManifest(args.manifest or os.path.join(npz_path, MANIFEST_NAME))
+        params = tiling_params(args)
+        scenes, on_done = incremental_scenes(manifest, 'filter', scenes, npz_path, lambda filename: params, args.hash)
+    process = partial(process_scene, npz_path=npz_path, strip=args.strip,
+                      legacy_npz=args.legacy_npz, prescreen=args.prescreen,
+                      prescreen_overviews=args.prescreen_overviews,
+                      codec=args.codec, codec_threads=args.codec_threads)
+    options = dict(workers=args.workers, gdal_cache_mb=args.gdal_cache_mb, on_done=on_done)
+    if args.queue_dir:
+        _, failures = run_scene_queue(process, scenes, args.queue_dir, args.unit_size, args.lease_seconds, **options)
+    else:
+        _, failures = run_scenes(process, scenes, **options)
+    for filename, error in failures:
+        print(f'{filename} failed: {error}')
+    return failures
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     # crop tif to npz
     parser.add_argument('--np_dir', type=str, required=False, help='The directory to store np array')
-    parser.add_argument('--input_dir', type=str, default=None, help='directory to find usgs tif files')
+    parser.add_argument('--input_dir', type=str, default=None, help='directory to find usgs tif files (or the downloaded zips)')
+    add_tiling_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1, help='number of scenes processed in parallel')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip scenes whose input and parameters are unchanged since they were last tiled')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help=f'sqlite manifest of --incremental (default: <np_dir>/{MANIFEST_NAME}), '
+                             'required on local disk with --queue_dir')
+    parser.add_argument('--hash', action='store_true', help='with --incremental, compare inputs by sha256 instead of size/mtime')
+    work_queue.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     # load tif from npz
     parser.add_argument('--npz_file', type=str, default=None, help='path to npz file')
     parser.add_argument('--tif_output_dir', type=str, default=None, help='directory to store tif files from numpy')
     args = parser.parse_args()
+    if args.incremental and args.queue_dir and args.manifest is None:
+        # every node would write <np_dir>/tiling_manifest.sqlite on the shared filesystem
+        parser.error('--incremental with --queue_dir needs a --manifest on local disk, '
+                     'SQLite is not safe to share over NFS')
+    metrics.configure_from_args(args)
     if args.npz_file == None and args.tif_output_dir == None:
         main(args)
     else:
-        load_tif_from_np(args.npz_file, args.tif_output_dir)
+        with metrics.stage('load_tif_from_np'):
+            load_tif_from_np(args.npz_file, args.tif_output_dir)
+    metrics.finish()
 
 
     
@@ -1,32 +1,89 @@
 import rasterio
 import numpy as np
 import os
-from tqdm import tqdm
 import time
 from rasterio.windows import Window
 import argparse
+from functools import partial
+from tile_store import save_tiles, load_tiles, tile_records, add_codec_arguments, TILE_FORMAT_VERSION
+from tiling_manifest import TilingManifest, incremental_scenes, scene_fingerprint, MANIFEST_NAME
+import metrics
+from tiling import run_scenes, list_scenes, select_tiles, read_tiles, tile_record, scene_size, atomic_write
 import geopandas as gpd
+import re
+from functools import lru_cache
+from shapely.geometry import box
 from rasterio.features import rasterize
 
 PATH_TO_CENTERLINE = '/scratch/bbkc/zoezheng126/Greyscale/ISGS_Centerlines'
-CENTERLINE_DIR = [name for name in os.listdir(PATH_TO_CENTERLINE)]
-print(CENTERLINE_DIR)
-def load_mask(path, src):
-    meta = src.meta
+# separators between the parts of a tif name, used to look up centerline directory names
+NAME_SEPARATORS = re.compile(r'[_\-. ]')
+
+@lru_cache(maxsize=None)
+def centerline_lookup(centerline_dir=PATH_TO_CENTERLINE):
+    """
+    Map each centerline directory name to the shapefile inside it, listing the disk only once.
+
+    :param centerline_dir: Directory with one sub-directory (containing a .shp) per area
+    :return: Dict of directory name -> path of its shapefile
+    """
+    lookup = {}
+    for name in os.listdir(centerline_dir):
+        path = os.path.join(centerline_dir, name)
+        if not os.path.isdir(path):
+            continue
+        shapefiles = sorted(f for f in os.listdir(path) if f.endswith('.shp'))
+        if shapefiles:
+            lookup[name] = os.path.join(path, shapefiles[0])
+    return lookup
+
+@lru_cache(maxsize=None)
+def centerline_pattern(centerline_dir=PATH_TO_CENTERLINE):
+    # every centerline directory name, longest first, so one search finds the longest name in a tif name
+    names = sorted(centerline_lookup(centerline_dir), key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, names))) if names else None
+
+@lru_cache(maxsize=8)
+def read_centerlines(path):
+    # parse each shapefile once per process and build its spatial index up front
     gdf = gpd.read_file(path)
-    shapes = ((geom, 1) for geom in gdf.geometry)
-    gt_mask = rasterize(shapes, out_shape=(meta['height'], meta['width']), fill=0, transform=src.transform, dtype='float32')
+    gdf.sindex
+    return gdf
+
+def load_mask(path, src):
+    """
+    Rasterize the centerlines that fall on src into a uint8 mask of the scene's shape.
+
+    Only geometries whose bounding box intersects the scene (found through the layer's
+    spatial index) are burned in.
+    """
+    gdf = read_centerlines(path)
+    hits = gdf.sindex.query(box(*src.bounds))
+    shapes = [(geom, 1) for geom in gdf.geometry.iloc[hits] if geom is not None and not geom.is_empty]
+    if not shapes:
+        return np.zeros((src.height, src.width), dtype=np.uint8)
+    gt_mask = rasterize(shapes, out_shape=(src.height, src.width), fill=0, transform=src.transform, dtype='uint8')
 
     return gt_mask
 
-def find_shp(tif_filename):
-    for name in CENTERLINE_DIR:
-        if name in tif_filename:
-            path = os.path.join(PATH_TO_CENTERLINE, name)
-            shapefile = [name for name in os.listdir(path)
-                  if name.endswith('.shp')][0]
-            
-            return os.path.join(path, shapefile)
+@lru_cache(maxsize=None)
+def find_shp(tif_filename, centerline_dir=PATH_TO_CENTERLINE):
+    # cached, so a tif without centerlines is looked up (and reported) once per process
+    lookup = centerline_lookup(centerline_dir)
+    # try every run of separator-delimited parts of the name, longest first
+    bounds = [0] + [m.end() for m in NAME_SEPARATORS.finditer(tif_filename)] + [len(tif_filename) + 1]
+    spans = sorted(((i, j) for i in range(len(bounds) - 1) for j in range(i + 1, len(bounds))),
+                   key=lambda span: span[0] - span[1])
+    for i, j in spans:
+        shapefile = lookup.get(tif_filename[bounds[i]:bounds[j] - 1])
+        if shapefile is not None:
+            return shapefile
+    # names that are not whole parts of the tif name
+    pattern = centerline_pattern(centerline_dir)
+    match = pattern.search(tif_filename) if pattern is not None else None
+    if match is not None:
+        return lookup[match.group()]
+    print(f'no centerline directory matches {tif_filename}, skipping it')
 
 # crop and save to tif directly
 def crop(src, i_c, j_c,crop_tif_path, s_path = None, h=512,w=512):
@@ -49,22 +106,11 @@ def crop(src, i_c, j_c,crop_tif_path, s_path = None, h=512,w=512):
                         
     #makeup_mask(transform,crop_tif_path, s_path,h,w)
 
-# crop and later save to one np file for each 5000*5000 tif                        
+# crop and later save to one np file for each 5000*5000 tif
 def crop_to_npz(src, i_c, j_c, h=512, w=512):
-    # Compute the top left geographic (x, y) coordinates of the cropped TIFF
-    x_offset, y_offset = src.xy(i_c, j_c)
-    
     # Read the cropped data from the source
-    cropped_data = src.read(window=Window(j_c, i_c, h, w))
-
-    # Save cropped data, transform, and CRS to a NumPy (NPZ) file
-    #np.savez(npz_path, data=cropped_data, transform=transform, crs=src.crs)
-    return {
-            'data': cropped_data,
-            'crs': src.crs,
-            'x_offset': x_offset,
-            'y_offset': y_offset
-    }
+    cropped_data = src.read(window=Window(j_c, i_c, w, h))
+    return tile_record(src, i_c, j_c, cropped_data)
 
 def check_ndwi_sum(ndwi, i_c, j_c, h=512, w=512, pad=256):
     """
@@ -94,32 +140,28 @@ def check_ndwi_sum(ndwi, i_c, j_c, h=512, w=512, pad=256):
     
 
 def sliding_crop(src, ndwi, h=512, w=512):
-    tif = src.read()
-    _,tif_h,tif_w=tif.shape
-    x_start,y_start=0,0
-    x_end, y_end = 0,0
+    # keep the tiles whose padded window contains any centerline pixel (see check_ndwi_sum)
+    rows, cols = select_tiles(ndwi, h, w, min_sum=0, pad=256)
     results = []
-    while (y_end < tif_h):
-        y_end = y_start + h
-        if y_end > tif_h:
-            y_start = tif_h - h
-            if y_start < 0: break
-            y_end = tif_h + 1
-        x_start,x_end = 0,0
-        while (x_end < tif_w):
-            x_end = x_start + w
-            if x_end > tif_w: 
-                x_start = tif_w - w
-                if x_start < 0: break
-                x_end = tif_w + 1
-            if check_ndwi_sum(ndwi,y_start,x_start,h,w):
-                metadata = crop_to_npz(src, y_start, x_start)
-                results.append(metadata)
-                
-            x_start = x_end
-        y_start = y_end
+    for i_c, j_c in zip(rows.tolist(), cols.tolist()):
+        metadata = crop_to_npz(src, i_c, j_c)
+        results.append(metadata)
     return results
 
+def tile_scene(src, centerline, h=512, w=512, strip=False):
+    """
+    Crop the tiles near a centerline, decoding the scene's pixels only once.
+
+    The tiles are selected from the centerline mask first. They are then sliced out of a single
+    full read of the scene, or with strip=True out of one strip of tile height at a time
+    (see tiling.read_tiles).
+
+    :return: List of tile_record dicts, same as sliding_crop(src, centerline)
+    """
+    rows, cols, scores = select_tiles(centerline, h, w, min_sum=0, pad=256, return_scores=True)
+    return [tile_record(src, i_c, j_c, data, score)
+            for (i_c, j_c, data), score in zip(read_tiles(src, rows, cols, h, w, strip), scores.tolist())]
+
 def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filename):
     """
     Save crops stored in cropping results to individual TIFF files.
@@ -129,7 +171,7 @@ def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filen
     - base_tiff_path: Base path for saving TIFF files.
     """
     data = cropping_results['data']
-    tiff_name = f"{str(filename)[:-4]}_crop_{cropping_results['x_offset']}_{cropping_results['y_offset']}.tif"
+    tiff_name = f"{os.path.splitext(str(filename))[0]}_crop_{cropping_results['x_offset']}_{cropping_results['y_offset']}.tif"
     tiff_path = os.path.join(base_tiff_path, tiff_name)
     trans = rasterio.Affine(a, b, cropping_results['x_offset'],
                             d, e, cropping_results['y_offset'])
@@ -141,55 +183,97 @@ def save_npz_crops_to_tiffs(cropping_results, base_tiff_path,a,b,d,e,count,filen
         dst.write(data)
 
 def load_tif_from_np(npz_path,base_tiff_path):
-    with np.load(npz_path, allow_pickle=True) as npz:
-        results = {key: npz[key] for key in npz.files}
-
-        a = results['a']
-        b = results['b']
-        d = results['d']
-        e = results['e']
-        count = results['count']
-        filename = results['filename']
-        for r in results['accumulated_results']:
-            save_npz_crops_to_tiffs(r,base_tiff_path,a,b,d,e,count,filename)
+    # reads both the columnar layout and the old pickled accumulated_results layout
+    store = load_tiles(npz_path)
+    a, b, _, d, e, _ = store['transform']
+    for r in tile_records(store):
+        save_npz_crops_to_tiffs(r,base_tiff_path,a,b,d,e,store['count'],store['filename'])
+
+def process_scene(filename, path, npz_path, shp_path=None, strip=False, legacy_npz=False,
+                  centerline_dir=PATH_TO_CENTERLINE, codec='none', codec_threads=None):
+    if shp_path == None:
+        shp_path = find_shp(filename, centerline_dir)
+    if shp_path == None:
+        return False
+    print(path)
+    print(shp_path)
+    with metrics.stage('scene', scene=filename) as scene_metrics, rasterio.open(path) as src:
+        scene_metrics['bytes_in'] = scene_size(path)
+        with metrics.stage('centerline', scene=filename):
+            centerline = load_mask(shp_path, src)
+        src_name = os.path.splitext(filename)[0] + '.npz'
+        with metrics.stage('tile', scene=filename) as m:
+            results = tile_scene(src, centerline, h=512, w=512, strip=strip)
+            m['tiles'] = len(results)
+        npz_file = os.path.join(npz_path, src_name)
+        with metrics.stage('save', scene=filename) as m:
+            # written under a temporary name and renamed, so a crash never leaves a truncated npz
+            with atomic_write(npz_file) as f:
+                if legacy_npz:
+                    np.savez_compressed(f, accumulated_results=results,\
+                                        a=src.transform.a, b=src.transform.b,\
+                                        d=src.transform.d, e=src.transform.e,\
+                                            count=src.count, filename=filename)
+                else:
+                    save_tiles(f, src, filename, results, codec=codec, threads=codec_threads)
+            m['bytes_out'] = os.path.getsize(npz_file)
+        scene_metrics['tiles'] = len(results)
+        scene_metrics['bytes_out'] = m['bytes_out']
+    return True
+
+def tiling_params(args, filename):
+    # everything that changes the contents of a scene's npz, including its centerlines, see --incremental
+    shp_path = args.shp_path if args.shp_path != None else find_shp(filename, args.centerline_dir)
+    return {'h': 512, 'w': 512, 'pad': 256, 'min_sum': 0, 'legacy_npz': args.legacy_npz, 'codec': args.codec,
+            'format_version': TILE_FORMAT_VERSION, 'shp_path': shp_path,
+            'shp': scene_fingerprint(shp_path) if shp_path != None else None}
 
 def main(args):
-    outputs = []
     input_dir = args.input_dir
     npz_path = args.output_dir
-    
-    for filename in tqdm(os.listdir(input_dir)):
-        tmp = os.path.join(input_dir,filename)
-        if args.shp_path != None:
-            shp_path = args.shp_path
-        else:
-            shp_path = find_shp(filename)
-        if shp_path == None:
-            outputs.append(filename)
-            continue
-        print(tmp)
-        print(shp_path)
-        with rasterio.open(tmp) as src:
-            centerline = load_mask(shp_path, src)
-            src_name = filename[:-4] + '.npz'
-            results = sliding_crop(src,centerline, h=512,w=512)
-            npz_file = os.path.join(npz_path, src_name)
-            np.savez_compressed(npz_file, accumulated_results=results,\
-                                a=src.transform.a, b=src.transform.b,\
-                                d=src.transform.d, e=src.transform.e,\
-                                    count=src.count, filename=filename)
+
+    if args.shp_path == None:
+        print(sorted(centerline_lookup(args.centerline_dir)))
+    scenes = list_scenes(input_dir)
+    on_done = None
+    if args.incremental:
+        manifest = TilingManifest(args.manifest or os.path.join(npz_path, MANIFEST_NAME))
+        scenes, on_done = incremental_scenes(manifest, 'filter_greyscale', scenes, npz_path,
+                                             partial(tiling_params, args), args.hash)
+    results, failures = run_scenes(partial(process_scene, npz_path=npz_path, shp_path=args.shp_path, strip=args.strip,
+                                           legacy_npz=args.legacy_npz, centerline_dir=args.centerline_dir,
+                                           codec=args.codec, codec_threads=args.codec_threads),
+                                   scenes, workers=args.workers, gdal_cache_mb=args.gdal_cache_mb, on_done=on_done)
+    for filename, error in failures:
+        print(f'{filename} failed: {error}')
+    # tifs without a corresponding shapefile
+    outputs = sorted(filename for filename, found in results.items() if not found)
     return outputs
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     # crop tif to npz
-    parser.add_argument('--input_dir', type=str, default=None, help='directory to find usgs tif files')
+    parser.add_argument('--input_dir', type=str, default=None, help='directory to find usgs tif files (or the downloaded zips)')
     parser.add_argument('--output_dir', type=str, help='The directory to store npz files')
     parser.add_argument('--shp_path', type=str, default=None, help='path to the centerline file')
+    parser.add_argument('--centerline_dir', type=str, default=PATH_TO_CENTERLINE,
+                        help='directory of per-area centerline shapefiles, used when --shp_path is not given')
+    parser.add_argument('--strip', action='store_true', help='read each scene in strips of tile height to bound memory')
+    add_codec_arguments(parser)
+    parser.add_argument('--legacy_npz', action='store_true', help='write the old pickled accumulated_results layout')
+    parser.add_argument('--workers', type=int, default=1, help='number of scenes processed in parallel')
+    parser.add_argument('--gdal_cache_mb', type=int, default=256, help='GDAL block cache of each worker process')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip scenes whose input, centerlines and parameters are unchanged since they were last tiled')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help=f'sqlite manifest of --incremental (default: <output_dir>/{MANIFEST_NAME})')
+    parser.add_argument('--hash', action='store_true', help='with --incremental, compare inputs by sha256 instead of size/mtime')
+    metrics.add_arguments(parser)
     # load tif from npz
     parser.add_argument('--npz_file', type=str, default=None, help='path to npz file')
     parser.add_argument('--tif_output_dir', type=str, default=None, help='directory to store tif files from numpy')
     args = parser.parse_args()
+    metrics.configure_from_args(args)
     if args.npz_file == None and args.tif_output_dir == None:
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
@@ -200,6 +284,8 @@ if __name__ == '__main__':
         outputs = main(args)
         print(f'the following tif do not have a corresponding shapefile: \n{outputs}')
     else:
-        load_tif_from_np(args.npz_file, args.tif_output_dir)
+        with metrics.stage('load_tif_from_np'):
+            load_tif_from_np(args.npz_file, args.tif_output_dir)
+    metrics.finish()
 
     
@@ -0,0 +1,277 @@
+# Opt-in per-stage metrics shared by usgs-download.py, filter.py, filter_greyscale.py and the
+# npz converters.
+#
+#   with metrics.stage('ndwi', scene=filename) as m:
+#       ...
+#       m['tiles'] = len(results)
+#
+# Every stage records wall and CPU time, bytes in/out and tiles (when the caller sets them),
+# tiles/s and the peak RSS reached during the stage, as one JSON line per stage. A run can also be
+# rendered as a Prometheus textfile, and chosen stages can be run under cProfile.
+# Nothing is measured or written unless configure() was called (the --metrics /
+# --prometheus / --profile flags), so the default cost of a stage is one dict lookup.
+#
+# The settings live in environment variables, so worker processes started by the scripts'
+# pools record into the same file without any extra plumbing.
+
+import contextlib
+import cProfile
+import itertools
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import uuid
+
+ENV_JSONL = 'USGS_METRICS_JSONL'
+ENV_PROFILE = 'USGS_METRICS_PROFILE'
+ENV_RUN = 'USGS_METRICS_RUN'
+
+_write_lock = threading.Lock()
+_prometheus = None
+# labels of the enclosing stages of each thread, inherited by nested stages
+_local = threading.local()
+_profile_count = 0
+# RSS high-water marks of the stages open in this process, see _begin_peak
+_peak_lock = threading.Lock()
+_open_peaks = {}
+_peak_tokens = itertools.count()
+_can_reset_peak = sys.platform.startswith('linux')
+# highest mark seen before a reset, which also clears ru_maxrss
+_process_peak_mb = 0.0
+
+
+def add_arguments(parser):
+    """Add the --metrics, --prometheus and --profile options to an argparse parser."""
+    parser.add_argument('--metrics', type=str, default=None, help='append per-stage metrics to this JSON-lines file')
+    parser.add_argument('--prometheus', type=str, default=None,
+                        help='write a Prometheus textfile summarising the stages of this run')
+    parser.add_argument('--profile', type=str, nargs='+', default=None,
+                        help='run these stages under cProfile, the .prof files go next to the metrics file')
+
+
+def configure(jsonl=None, prometheus=None, profile=None):
+    """
+    Turn metrics on for this process and the processes it starts.
+
+    :param jsonl: JSON-lines file the stage records are appended to. Defaults to
+                  <prometheus>.jsonl when only prometheus is given.
+    :param prometheus: Textfile written by finish(), for node_exporter's textfile collector
+    :param profile: Names of the stages to run under cProfile
+    """
+    global _prometheus
+    if jsonl is None and prometheus is not None:
+        jsonl = prometheus + '.jsonl'
+    if jsonl is None and profile:
+        jsonl = os.devnull
+    if jsonl is None:
+        return
+    os.environ[ENV_JSONL] = os.path.abspath(jsonl)
+    os.environ[ENV_RUN] = uuid.uuid4().hex
+    if profile:
+        os.environ[ENV_PROFILE] = ','.join(profile)
+    _prometheus = prometheus
+
+
+def configure_from_args(args):
+    configure(args.metrics, args.prometheus, args.profile)
+
+
+def enabled():
+    return ENV_JSONL in os.environ
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    peak = peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+    return max(peak, _process_peak_mb)
+
+
+def _vm_hwm_mb():
+    # the kernel's RSS high-water mark of this process, None where /proc is not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _begin_peak():
+    """
+    Start measuring the peak RSS of a stage, by resetting the process's high-water mark.
+
+    The mark belongs to the whole process, so before it is reset its value is folded into
+    every stage that is still open (enclosing stages, stages of other threads); each of them
+    ends up with the peak over its own lifetime. Returns None where the mark cannot be reset
+    (not Linux, or /proc/self/clear_refs not writable), and only the process peak is recorded.
+    """
+    global _can_reset_peak, _process_peak_mb
+    if not _can_reset_peak:
+        return None
+    with _peak_lock:
+        hwm = _vm_hwm_mb()
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            hwm = None
+        if hwm is None:
+            _can_reset_peak = False
+            return None
+        _process_peak_mb = max(_process_peak_mb, hwm)
+        for token in _open_peaks:
+            _open_peaks[token] = max(_open_peaks[token], hwm)
+        token = next(_peak_tokens)
+        _open_peaks[token] = 0.0
+        return token
+
+
+def _end_peak(token):
+    global _process_peak_mb
+    with _peak_lock:
+        peak = max(_open_peaks.pop(token), _vm_hwm_mb() or 0.0)
+        _process_peak_mb = max(_process_peak_mb, peak)
+        return peak
+
+
+def _profile_path(name):
+    global _profile_count
+    _profile_count += 1
+    jsonl = os.environ[ENV_JSONL]
+    directory = os.path.dirname(jsonl) if jsonl != os.devnull else os.getcwd()
+    return os.path.join(directory, f'{name}-{os.getpid()}-{_profile_count}.prof')
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """
+    Measure one stage and append its record to the metrics file.
+
+    Yields a dict the caller can fill with bytes_in, bytes_out, tiles or any other number;
+    they are written with the record. Stages nest and inherit the labels of the stages around
+    them, and a stage that raises is recorded with its error before the exception propagates.
+
+    cpu_s is the CPU time of the calling thread only, so concurrent stages in other threads
+    are not charged to it, but neither is work the stage hands to helper threads (e.g. codec
+    threads). process_cpu_s is the CPU time of the whole process over the stage and includes
+    both. peak_rss_mb is the highest RSS reached while the stage ran (Linux only), and
+    process_peak_rss_mb the highest the process has reached since it started.
+
+    :param name: Stage name, e.g. 'search', 'transfer', 'ndwi', 'save'
+    :param labels: Extra fields of the record, e.g. scene=filename
+    """
+    values = {}
+    if not enabled():
+        yield values
+        return
+    outer = getattr(_local, 'labels', {})
+    labels = dict(outer, **labels)
+    _local.labels = labels
+    profiler = None
+    if name in os.environ.get(ENV_PROFILE, '').split(','):
+        profiler = cProfile.Profile()
+    error = None
+    peak = _begin_peak()
+    wall = time.perf_counter()
+    # CPU time of this thread, so concurrent downloads are not charged for each other
+    cpu = time.thread_time()
+    process_cpu = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield values
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _local.labels = outer
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_profile_path(name))
+        wall = time.perf_counter() - wall
+        record = {'run': os.environ.get(ENV_RUN), 'stage': name, 'host': socket.gethostname(), 'pid': os.getpid(),
+                  'time': time.time(), 'wall_s': wall, 'cpu_s': time.thread_time() - cpu,
+                  'process_cpu_s': time.process_time() - process_cpu}
+        # the stage peak first: ending it folds the current high-water mark into the process peak
+        if peak is not None:
+            record['peak_rss_mb'] = _end_peak(peak)
+        record['process_peak_rss_mb'] = max(peak_rss_mb(), record.get('peak_rss_mb', 0.0))
+        record.update(labels)
+        record.update(values)
+        if 'tiles' in values and wall > 0:
+            record['tiles_per_s'] = values['tiles'] / wall
+        if error is not None:
+            record['error'] = error
+        _write(record)
+
+
+def _write(record):
+    # one write() per line on a file opened for append, so lines from several processes don't interleave
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        with open(os.environ[ENV_JSONL], 'a') as f:
+            f.write(line)
+
+
+def read_records(path, run=None):
+    """Records of a JSON-lines metrics file, only those of one run if run is given."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if run is None or record.get('run') == run:
+                    records.append(record)
+    return records
+
+
+def write_prometheus(records, path):
+    """
+    Summarise stage records as a Prometheus textfile (totals per stage).
+
+    The file is written to a temporary name and renamed, as the textfile collector expects.
+    """
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r['stage'], {'count': 0, 'errors': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'process_cpu_s': 0.0,
+                                           'bytes_in': 0, 'bytes_out': 0, 'tiles': 0, 'peak_rss_mb': 0.0})
+        t['count'] += 1
+        t['errors'] += 'error' in r
+        for key in ('wall_s', 'cpu_s', 'process_cpu_s', 'bytes_in', 'bytes_out', 'tiles'):
+            t[key] += r.get(key, 0) or 0
+        # records of platforms without a per-stage peak fall back to the process peak
+        t['peak_rss_mb'] = max(t['peak_rss_mb'], r.get('peak_rss_mb', r.get('process_peak_rss_mb', 0)))
+    metrics = [('usgs_stage_runs_total', 'count', 'counter', 'Number of times the stage ran'),
+               ('usgs_stage_errors_total', 'errors', 'counter', 'Number of times the stage raised'),
+               ('usgs_stage_wall_seconds_total', 'wall_s', 'counter', 'Wall-clock time spent in the stage'),
+               ('usgs_stage_cpu_seconds_total', 'cpu_s', 'counter', 'CPU time of the thread running the stage'),
+               ('usgs_stage_process_cpu_seconds_total', 'process_cpu_s', 'counter',
+                'CPU time of the whole process while the stage ran'),
+               ('usgs_stage_bytes_in_total', 'bytes_in', 'counter', 'Bytes read by the stage'),
+               ('usgs_stage_bytes_out_total', 'bytes_out', 'counter', 'Bytes written by the stage'),
+               ('usgs_stage_tiles_total', 'tiles', 'counter', 'Tiles produced by the stage'),
+               ('usgs_stage_peak_rss_megabytes', 'peak_rss_mb', 'gauge', 'Largest peak RSS seen in the stage')]
+    lines = []
+    for metric, key, kind, help_text in metrics:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, t in sorted(totals.items()):
+            lines.append(f'{metric}{{stage="{name}"}} {t[key]}')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+def finish():
+    """Write the Prometheus textfile of this run, if one was asked for in configure()."""
+    if _prometheus is not None and enabled():
+        write_prometheus(read_records(os.environ[ENV_JSONL], os.environ.get(ENV_RUN)), _prometheus)
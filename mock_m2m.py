@@ -0,0 +1,254 @@
+# Local stand-in for the USGS M2M JSON API, for testing and benchmarking usgs-download.py
+# without touching https://m2m.cr.usgs.gov.
+#
+# Implements login, dataset-search, scene-search, download-options, download-request,
+# download-retrieve and logout, plus a /download/<downloadId> endpoint that serves a zip
+# (one stored <displayId>.tif member of --file_size bytes, or a copy of --tif) with HTTP
+# Range support.
+#
+# Usage: python mock_m2m.py --port 8642 --scenes 200 --preparing 0.5 --prepare_delay 10
+#        python usgs-download.py -u x -p x -o out --service_url http://127.0.0.1:8642/
+
+import argparse
+import io
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DATASET_NAME = 'high_res_ortho'
+API_KEY = 'mock-api-key'
+
+
+class MockState:
+    """Scenes, download requests and behaviour knobs shared by all handler threads."""
+
+    def __init__(self, scenes=100, file_size=10 * 1024 * 1024, latency=0.0, download_latency=0.0,
+                 preparing=0.0, prepare_delay=5.0, failure_rate=0.0, bandwidth=None, seed=0, tif=None):
+        self.scenes = scenes
+        self.file_size = file_size
+        self.latency = latency
+        self.download_latency = download_latency
+        self.preparing = preparing
+        self.prepare_delay = prepare_delay
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth   # bytes/s per connection, None for unthrottled
+        self.random = random.Random(seed)
+        # a real GeoTIFF when the client is going to tile what it downloads, random bytes otherwise
+        if tif is not None:
+            with open(tif, 'rb') as f:
+                self.payload = f.read()
+        else:
+            self.payload = random.Random(seed).randbytes(file_size)
+        self.lock = threading.Lock()
+        self.downloads = {}          # downloadId -> dict(entityId, displayId, label, ready_at)
+        self.by_product = {}         # (entityId, productId) -> downloadId
+        self.next_download_id = 1
+        self.zip_cache = {}
+
+    def display_id(self, entity_id):
+        return f'mock_{entity_id}'
+
+    # zip with a single stored GeoTIFF-named member, built once per display id
+    def zip_bytes(self, display_id):
+        with self.lock:
+            data = self.zip_cache.get(display_id)
+        if data is None:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+                zf.writestr(display_id + '.tif', self.payload)
+            data = buffer.getvalue()
+            with self.lock:
+                if len(self.zip_cache) > 64:
+                    self.zip_cache.clear()
+                self.zip_cache[display_id] = data
+        return data
+
+    def url(self, host, download_id):
+        return f'http://{host}/download/{download_id}'
+
+    def entry(self, host, download_id):
+        download = self.downloads[download_id]
+        return {'downloadId': download_id,
+                'entityId': download['entityId'],
+                'displayId': download['displayId'],
+                'url': self.url(host, download_id)}
+
+    # endpoint handlers, each returns the 'data' member of the response
+    def login(self, data, host):
+        return API_KEY
+
+    def logout(self, data, host):
+        return None
+
+    def dataset_search(self, data, host):
+        return [{'datasetAlias': DATASET_NAME, 'collectionName': 'High Resolution Orthoimagery'}]
+
+    def scene_search(self, data, host):
+        start = data.get('startingNumber', 1)
+        count = max(0, min(data.get('maxResults', 100), self.scenes - start + 1))
+        results = [{'entityId': f'E{i:07d}',
+                    'displayId': self.display_id(f'E{i:07d}'),
+                    'temporalCoverage': {'startDate': '2015-03-15 00:00:00', 'endDate': '2015-03-15 00:00:00'}}
+                   for i in range(start, start + count)]
+        return {'results': results, 'recordsReturned': count, 'totalHits': self.scenes,
+                'startingNumber': start, 'nextRecord': start + count}
+
+    def download_options(self, data, host):
+        return [{'id': f'P{entity_id}', 'entityId': entity_id, 'available': True,
+                 'filesize': self.file_size} for entity_id in data['entityIds']]
+
+    def download_request(self, data, host):
+        label = data.get('label')
+        now = time.time()
+        result = {'availableDownloads': [], 'preparingDownloads': [], 'failed': [],
+                  'newRecords': {}, 'duplicateProducts': {}}
+        with self.lock:
+            for request in data['downloads']:
+                key = (request['entityId'], request['productId'])
+                if key in self.by_product:
+                    download_id = self.by_product[key]
+                    result['duplicateProducts'][str(download_id)] = label
+                else:
+                    download_id = self.next_download_id
+                    self.next_download_id += 1
+                    self.by_product[key] = download_id
+                    delay = self.prepare_delay if self.random.random() < self.preparing else 0
+                    self.downloads[download_id] = {'entityId': request['entityId'],
+                                                   'displayId': self.display_id(request['entityId']),
+                                                   'label': label, 'ready_at': now + delay}
+                    result['newRecords'][str(download_id)] = label
+                bucket = 'availableDownloads' if self.downloads[download_id]['ready_at'] <= now \
+                    else 'preparingDownloads'
+                result[bucket].append(self.entry(host, download_id))
+        return result
+
+    def download_retrieve(self, data, host):
+        label = data.get('label')
+        now = time.time()
+        with self.lock:
+            available = [self.entry(host, download_id) for download_id, download in self.downloads.items()
+                         if download['label'] == label and download['ready_at'] <= now]
+        return {'available': available, 'requested': [], 'queueSize': 0}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        state = self.state
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        data = json.loads(body) if body else None
+        endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+        time.sleep(state.latency)
+
+        handler = getattr(state, endpoint.replace('-', '_'), None)
+        if handler is None:
+            self.send_json({'errorCode': 'UNKNOWN', 'errorMessage': f'no endpoint {endpoint}', 'data': None}, 404)
+            return
+        if endpoint != 'login' and self.headers.get('X-Auth-Token') != API_KEY:
+            self.send_json({'errorCode': 'AUTH_UNAUTHROIZED', 'errorMessage': 'invalid api key', 'data': None})
+            return
+        self.send_json({'errorCode': None, 'errorMessage': None, 'data': handler(data or {}, self.headers['Host'])})
+
+    def do_GET(self):
+        state = self.state
+        parts = self.path.strip('/').split('/')
+        with state.lock:
+            download = state.downloads.get(int(parts[1])) if len(parts) == 2 and parts[1].isdigit() else None
+        if parts[0] != 'download' or download is None or download['ready_at'] > time.time():
+            self.send_error(404)
+            return
+        time.sleep(state.download_latency)
+        if state.random.random() < state.failure_rate:
+            self.send_error(503)
+            return
+
+        data = state.zip_bytes(download['displayId'])
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0] or 0)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+
+        chunk_size = 256 * 1024
+        for offset in range(start, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            if state.bandwidth:
+                time.sleep(len(chunk) / state.bandwidth)
+
+
+# start a mock server on a background thread, returns (server, base url)
+def start_server(host='127.0.0.1', port=0, **config):
+    handler = type('BoundMockHandler', (MockHandler,), {'state': MockState(**config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}/'
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--scenes', type=int, default=100, help='number of scenes scene-search returns')
+    parser.add_argument('--file_size', type=int, default=10 * 1024 * 1024, help='bytes of imagery per scene')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--download_latency', type=float, default=0.0,
+                        help='seconds before a download starts sending bytes')
+    parser.add_argument('--preparing', type=float, default=0.0,
+                        help='fraction of downloads that start out preparing')
+    parser.add_argument('--prepare_delay', type=float, default=5.0,
+                        help='seconds a preparing download takes to become available')
+    parser.add_argument('--failure_rate', type=float, default=0.0,
+                        help='probability a download GET answers 503')
+    parser.add_argument('--bandwidth', type=float, default=None, help='per-connection MB/s cap')
+    parser.add_argument('--tif', type=str, default=None,
+                        help='serve this GeoTIFF as every scene instead of --file_size random bytes')
+
+
+def config_from_args(args):
+    return {'scenes': args.scenes, 'file_size': args.file_size, 'latency': args.latency,
+            'download_latency': args.download_latency, 'preparing': args.preparing,
+            'prepare_delay': args.prepare_delay, 'failure_rate': args.failure_rate,
+            'bandwidth': args.bandwidth * 1e6 if args.bandwidth else None, 'tif': args.tif}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server, url = start_server(args.host, args.port, **config_from_args(args))
+    print(f'mock M2M API listening on {url} (pid {os.getpid()})')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
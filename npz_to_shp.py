@@ -3,8 +3,13 @@ import geopandas as gpd
 import rasterio
 from rasterio.features import shapes
 import os
-from tqdm import tqdm
 import argparse
+from shapely.geometry import shape
+from prediction_reader import as_scalar, as_array, convert_files, convert_scenes, scene_tiles, iter_tiles
+import metrics
+
+# --format choices of the per-scene mode, and the extension of each
+VECTOR_DRIVERS = {'gpkg': ('GPKG', '.gpkg'), 'fgb': ('FlatGeobuf', '.fgb')}
 
 # convert a binary mask to shapefile
 # must include original tif's transform and output directory
@@ -12,10 +17,9 @@ def convert(binary_array,crop_info, shp_dir, h=512, w=512):
     a,b,d,e = crop_info['a'].item(),crop_info['b'].item(),crop_info['d'].item(),crop_info['e'].item()
     x_offset, y_offset = crop_info['x_offset'].item(), crop_info['y_offset'].item()
     filename = crop_info['filename'].item()
-    patch_filename = f'{filename[:-4]}_{x_offset}_{y_offset}.shp'
+    patch_filename = f'{os.path.splitext(filename)[0]}_{x_offset}_{y_offset}.shp'
     output_shp_path = os.path.join(shp_dir,patch_filename)
-    if hasattr(binary_array, "numpy"):
-        binary_array = binary_array.numpy()
+    binary_array = as_array(binary_array)
     if binary_array.shape == (h, w):
         binary_array = binary_array.reshape(1,h,w).astype(np.uint8)
         transform = rasterio.Affine(a, b, x_offset,
@@ -31,23 +35,88 @@ def convert(binary_array,crop_info, shp_dir, h=512, w=512):
 
     
 
-def main(args):
+def tile_polygons(binary_array, crop_info, h=512, w=512):
+    """
+    Polygons of the water pixels (value 1) of one predicted mask, in map coordinates.
+
+    Only the pixels equal to 1 are traced (shapes(..., mask=...)), so no background polygons
+    are built just to be filtered out afterwards.
+
+    :return: List of shapely geometries, empty if the mask is not (h, w)
+    """
+    binary_array = as_array(binary_array)
+    if binary_array.shape != (h, w):
+        return []
+    binary_array = binary_array.astype(np.uint8)
+    a,b,d,e = (as_scalar(crop_info[k]) for k in 'abde')
+    transform = rasterio.Affine(a, b, as_scalar(crop_info['x_offset']),
+                                d, e, as_scalar(crop_info['y_offset']))
+    return [shape(s) for s, v in shapes(binary_array, mask=binary_array == 1, transform=transform)]
 
-    for f in tqdm(os.listdir(args.input_dir)):
-            shp_batch = os.path.join(args.input_dir,f)
+def scene_to_vector(filename, tiles, output_dir, fmt='gpkg', dissolve=False, h=512, w=512):
+    """
+    Polygonize every tile of one scene and write them to a single vector file with one layer.
 
-            with np.load(shp_batch, allow_pickle=True) as npz:
-                    results = {key: npz[key] for key in npz.files}
-                    for item in results['batch_result']:
-                            b = dict(item)
-                            mask = b['pred_mask']
-                            crop_info = b['crop_info']
-                            convert(mask,crop_info,args.output_dir)
+    :param filename: Source tif name (crop_info['filename']), the output is <name>.gpkg / .fgb
+    :param tiles: List of (npz path, entry index, crop_info) of that scene from scene_tiles; the
+                  masks are read back from the batch files one at a time as they are polygonized
+    :param fmt: Key of VECTOR_DRIVERS
+    :param dissolve: Merge polygons that touch or overlap across tile seams, written as
+                     single-part polygons
+    :return: Tuple (output path, number of polygons written)
+    """
+    driver, extension = VECTOR_DRIVERS[fmt]
+    geometries = []
+    x_offsets = []
+    y_offsets = []
+    with metrics.stage('polygonize', scene=filename) as m:
+        for mask, crop_info in iter_tiles(tiles):
+            polygons = tile_polygons(mask, crop_info, h, w)
+            geometries.extend(polygons)
+            x_offsets.extend([as_scalar(crop_info['x_offset'])] * len(polygons))
+            y_offsets.extend([as_scalar(crop_info['y_offset'])] * len(polygons))
+        m['tiles'] = len(tiles)
+    crs = as_scalar(tiles[0][2]['crs']) if 'crs' in tiles[0][2] else None
+    gdf = gpd.GeoDataFrame({'value': np.ones(len(geometries), dtype=np.int32),
+                            'x_offset': x_offsets, 'y_offset': y_offsets},
+                           geometry=geometries, crs=crs)
+    if dissolve and len(gdf):
+        with metrics.stage('dissolve', scene=filename):
+            gdf = gdf[['value', 'geometry']].dissolve(by='value', as_index=False).explode(index_parts=False)
+            gdf = gdf.reset_index(drop=True)
+    layer = os.path.splitext(filename)[0]
+    output_path = os.path.join(output_dir, layer + extension)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    with metrics.stage('write', scene=filename) as m:
+        gdf.to_file(output_path, layer=layer, driver=driver)
+        m['bytes_out'] = os.path.getsize(output_path)
+    return output_path, len(gdf)
+
+def main_per_scene(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    convert_scenes(scene_to_vector, scene_tiles(args.input_dir), args.output_dir, workers=args.workers,
+                   fmt=args.format, dissolve=args.dissolve)
+
+def main(args):
+    convert_files(convert, args.input_dir, args.output_dir, workers=args.workers)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', type=str, required=True, help='The directory to store np array')
     parser.add_argument('--output_dir', type=str, required=True, help='directory to find usgs tif files')
+    parser.add_argument('--per_scene', action='store_true',
+                        help='write all tiles of a scene to one vector file instead of a shapefile per tile')
+    parser.add_argument('--format', type=str, default='gpkg', choices=sorted(VECTOR_DRIVERS),
+                        help='output format of --per_scene')
+    parser.add_argument('--dissolve', action='store_true', help='merge polygons across tile seams (--per_scene)')
+    parser.add_argument('--workers', type=int, default=1, help='number of batch files (or scenes with --per_scene) converted in parallel')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    main(args)
+    metrics.configure_from_args(args)
+    if args.per_scene:
+        main_per_scene(args)
+    else:
+        main(args)
+    metrics.finish()
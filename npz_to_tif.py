@@ -1,10 +1,13 @@
 import numpy as np
-import geopandas as gpd
 import rasterio
-from rasterio.features import shapes
 import os
-from tqdm import tqdm
 import argparse
+import rasterio.shutil
+from rasterio.windows import Window
+from prediction_reader import as_scalar, as_array, convert_files, convert_scenes, scene_tiles, iter_tiles
+import metrics
+
+OVERLAP_RULES = ('max', 'mean', 'last')
 
 # convert a binary mask to shapefile
 # must include original tif's transform and output directory
@@ -12,11 +15,10 @@ def convert(binary_array,crop_info, shp_dir, h=512, w=512):
     a,b,d,e = crop_info['a'].item(),crop_info['b'].item(),crop_info['d'].item(),crop_info['e'].item()
     x_offset, y_offset = crop_info['x_offset'].item(), crop_info['y_offset'].item()
     filename = crop_info['filename'].item()
-    crs = crop_info['crs']
-    patch_filename = f'{filename[:-4]}_{x_offset}_{y_offset}.tif'
+    crs = as_scalar(crop_info['crs'])
+    patch_filename = f'{os.path.splitext(filename)[0]}_{x_offset}_{y_offset}.tif'
     output_tif_path = os.path.join(shp_dir,patch_filename)
-    if hasattr(binary_array, "numpy"):
-        binary_array = binary_array.numpy()
+    binary_array = as_array(binary_array)
     if binary_array.shape == (h, w):
         binary_array = binary_array.reshape(1,h,w).astype(np.uint8)
 
@@ -33,6 +35,95 @@ def convert(binary_array,crop_info, shp_dir, h=512, w=512):
 
     
 
+def mask_array(binary_array, dtype=np.uint8):
+    # pred_mask as a 2-d numpy array of dtype, torch tensors and bool masks included
+    binary_array = as_array(binary_array)
+    return binary_array.reshape(binary_array.shape[-2:]).astype(dtype, copy=False)
+
+def mosaic_scene(filename, tiles, output_dir, rule='max', h=512, w=512):
+    """
+    Write all predicted tiles of one scene into a single Cloud-Optimized GeoTIFF.
+
+    The tiles are placed on the scene grid given by their offsets. Each mask is read back from
+    its batch file (iter_tiles) and written into its window of a tiled scratch GeoTIFF, so
+    only one batch and one tile are in memory at once. Where tiles
+    overlap (the edge tiles of sliding_crop), rule decides the value: 'max' keeps the
+    largest, 'last' keeps the tile written last (both written as uint8, like convert()),
+    'mean' averages them (written as float32). The scratch file is then copied to <scene>.tif
+    with the COG driver, which adds the internal tiling, compression and overviews, and is
+    removed even if the mosaic fails. Pixels not covered by any tile are 0.
+
+    :param filename: Source tif name (crop_info['filename'])
+    :param tiles: List of (npz path, entry index, crop_info) of that scene from scene_tiles,
+                  written in this order
+    :param rule: One of OVERLAP_RULES
+    :return: Path of the written COG
+    """
+    if rule not in OVERLAP_RULES:
+        raise ValueError(f'unknown overlap rule {rule}, expected one of {OVERLAP_RULES}')
+    info = tiles[0][2]
+    a,b,d,e = (as_scalar(info[k]) for k in 'abde')
+    x_offsets = np.array([as_scalar(c['x_offset']) for _, _, c in tiles])
+    y_offsets = np.array([as_scalar(c['y_offset']) for _, _, c in tiles])
+    # scene origin is the top left tile, same convention as convert(): offsets are tile origins
+    x0 = x_offsets.min() if a > 0 else x_offsets.max()
+    y0 = y_offsets.max() if e < 0 else y_offsets.min()
+    cols = np.rint((x_offsets - x0) / a).astype(int)
+    rows = np.rint((y_offsets - y0) / e).astype(int)
+    height, width = int(rows.max()) + h, int(cols.max()) + w
+
+    dtype = np.float32 if rule == 'mean' else np.uint8
+    profile = dict(driver='GTiff', height=height, width=width, count=2 if rule == 'mean' else 1,
+                   dtype=dtype, crs=as_scalar(info['crs']) if 'crs' in info else None,
+                   transform=rasterio.Affine(a, b, x0, d, e, y0),
+                   tiled=True, blockxsize=512, blockysize=512)
+    output_path = os.path.join(output_dir, os.path.splitext(filename)[0] + '.tif')
+    scratch_path = output_path + '.scratch.tif'
+    single_path = output_path + '.mean.tif'
+    try:
+        with metrics.stage('mosaic', scene=filename) as m, rasterio.open(scratch_path, 'w+', **profile) as dst:
+            m['tiles'] = len(tiles)
+            for (mask, _), row, col in zip(iter_tiles(tiles), rows.tolist(), cols.tolist()):
+                window = Window(col, row, w, h)
+                mask = mask_array(mask, dtype)
+                if rule == 'last':
+                    dst.write(mask, 1, window=window)
+                elif rule == 'max':
+                    dst.write(np.maximum(dst.read(1, window=window), mask), 1, window=window)
+                else:
+                    # band 1 accumulates the sum, band 2 the number of tiles
+                    total, count = dst.read(window=window)
+                    dst.write(np.stack([total + mask, count + 1]), window=window)
+            if rule == 'mean':
+                for _, window in dst.block_windows(1):
+                    total, count = dst.read(window=window)
+                    np.divide(total, count, out=total, where=count > 0)
+                    dst.write(total, 1, window=window)
+
+        if rule == 'mean':
+            # drop the count band before the COG copy
+            with rasterio.open(scratch_path) as src:
+                profile.update(count=1)
+                with rasterio.open(single_path, 'w', **profile) as dst:
+                    for _, window in src.block_windows(1):
+                        dst.write(src.read(1, window=window), 1, window=window)
+            os.remove(scratch_path)
+        with metrics.stage('cog', scene=filename) as m:
+            rasterio.shutil.copy(single_path if rule == 'mean' else scratch_path, output_path, driver='COG',
+                                 compress='DEFLATE', overview_resampling='average' if rule == 'mean' else 'nearest')
+            m['bytes_out'] = os.path.getsize(output_path)
+    finally:
+        # also when the mosaic fails, so no partial scratch tif is left behind
+        for path in (scratch_path, single_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return output_path
+
+def main_mosaic(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    convert_scenes(mosaic_scene, scene_tiles(args.input_dir), args.output_dir, workers=args.workers,
+                   rule=args.overlap)
+
 def main(args):
 
     if not os.path.exists(args.output_dir):
@@ -42,21 +133,23 @@ def main(args):
         result = "Directory already exists."
     print(result)
 
-    for f in tqdm(os.listdir(args.input_dir)):
-            shp_batch = os.path.join(args.input_dir,f)
-
-            with np.load(shp_batch, allow_pickle=True) as npz:
-                    results = {key: npz[key] for key in npz.files}
-                    for item in results['batch_result']:
-                            b = dict(item)
-                            mask = b['pred_mask']
-                            crop_info = b['crop_info']
-                            convert(mask,crop_info,args.output_dir)
+    convert_files(convert, args.input_dir, args.output_dir, workers=args.workers)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', type=str, required=True, help='The directory to store np array')
     parser.add_argument('--output_dir', type=str, required=True, help='directory to find usgs tif files')
+    parser.add_argument('--mosaic', action='store_true',
+                        help='write all tiles of a scene into one Cloud-Optimized GeoTIFF instead of a tif per tile')
+    parser.add_argument('--overlap', type=str, default='max', choices=OVERLAP_RULES,
+                        help='value of pixels covered by several tiles (--mosaic)')
+    parser.add_argument('--workers', type=int, default=1, help='number of batch files (or scenes with --mosaic) converted in parallel')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    main(args)
+    metrics.configure_from_args(args)
+    if args.mosaic:
+        main_mosaic(args)
+    else:
+        main(args)
+    metrics.finish()
@@ -0,0 +1,276 @@
+# Search, download, extraction and tiling as one streaming pipeline.
+#
+# Usage: python pipeline.py -u username -p password -o zips --np_dir npz --workers 4 --tile_workers 2 --delete_raw
+#
+# usgs-download.py and filter.py otherwise run one after the other, so tiling only starts once
+# the slowest scene of the order has arrived. Here every scene goes to a pool of tiling
+# processes as soon as its download finishes, and scene k is tiled while k+1 downloads:
+#
+#   M2M search/request -> download threads (--workers) -> queue (--queue_size) -> tiling processes (--tile_workers)
+#
+# The queue is bounded. When tiling falls behind, the download threads block on it instead
+# of filling the disk with scenes nobody is tiling yet. A download also waits before it starts
+# while the output filesystem has less than --min_free_gb free. With --delete_raw, a scene's
+# zip (and the tifs extracted from it) are removed once all of its tifs are tiled. Tiled scenes
+# are recorded in filter.py's manifest, so a later filter.py --incremental skips them.
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import filter as rgb_filter
+import metrics
+from scene_catalog import SceneCatalog
+from tiling import _init_worker, zip_scenes
+from tiling_manifest import MANIFEST_NAME, TilingManifest, scene_fingerprint
+
+usgs_download = importlib.import_module('usgs-download')
+
+
+def wait_for_disk(path, min_free_gb, interval=10):
+    """
+    Block while the filesystem holding path has less than min_free_gb free.
+
+    :return: Seconds spent waiting
+    """
+    start = time.time()
+    warned = False
+    while min_free_gb and shutil.disk_usage(path).free < min_free_gb * 1e9:
+        if not warned:
+            print(f'less than {min_free_gb} GB free under {path}, holding downloads until tiling frees space')
+            warned = True
+        time.sleep(interval)
+    return time.time() - start
+
+
+class TilingStage:
+    """Bounded queue of downloaded scenes feeding a pool of tiling processes.
+
+    A dispatcher thread moves scenes from the queue to the pool, but never more than one per
+    idle worker, so the queue only drains as fast as scenes are tiled and put() blocks once it
+    is full. The raw files a group of scenes came from (zip, extracted tifs) are deleted when
+    every scene of the group was tiled, if delete_raw is set; a failed scene keeps them.
+    """
+
+    def __init__(self, process_scene, workers=1, queue_size=2, gdal_cache_mb=256, delete_raw=False, on_done=None):
+        self.process_scene = process_scene
+        self.delete_raw = delete_raw
+        self.on_done = on_done
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.slots = threading.Semaphore(workers)
+        # spawned rather than forked, the download threads may hold locks at fork time
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(gdal_cache_mb,))
+        self.lock = threading.Lock()
+        self.results = {}
+        self.failures = []
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def put(self, scenes, raw_files=()):
+        """
+        Queue scenes for tiling, blocking while the queue is full.
+
+        :param scenes: List of (filename, path) from one download
+        :param raw_files: Files to delete once all of these scenes are tiled
+        """
+        group = {'remaining': len(scenes), 'failed': False, 'raw': list(raw_files)}
+        if not scenes:
+            # nothing left to tile in this download
+            self._release(group)
+        for filename, path in scenes:
+            with metrics.stage('tiling-queue', scene=filename):
+                self.queue.put((filename, path, group))
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.slots.acquire()
+            filename, path, group = item
+            try:
+                future = self.executor.submit(self.process_scene, filename, path)
+            except Exception as e:
+                # a broken pool fails the scenes that are still coming instead of blocking put()
+                self.slots.release()
+                self._finish(filename, group, error=e)
+                continue
+            future.add_done_callback(partial(self._done, filename, path, group))
+
+    def _done(self, filename, path, group, future):
+        self.slots.release()
+        error = future.exception()
+        result = future.result() if error is None else None
+        # recorded before _finish, which may delete the raw files the fingerprint is read from
+        if error is None and self.on_done is not None:
+            try:
+                self.on_done(filename, path, result)
+            except Exception as e:
+                print(f'could not record {filename} ({e!r})')
+        self._finish(filename, group, error, result)
+
+    def _finish(self, filename, group, error=None, result=None):
+        with self.lock:
+            if error is None:
+                self.results[filename] = result
+            else:
+                self.failures.append((filename, repr(error)))
+                group['failed'] = True
+            group['remaining'] -= 1
+            release = group['remaining'] == 0 and not group['failed']
+        if error is not None:
+            print(f'{filename} could not be tiled ({error!r}), its raw files are kept')
+            return
+        print(f'tiled {filename} ({result} tiles)')
+        if release:
+            self._release(group)
+
+    def _release(self, group):
+        if self.delete_raw:
+            for raw in group['raw']:
+                if os.path.exists(raw):
+                    os.remove(raw)
+
+    def close(self):
+        """
+        Wait until every queued scene is tiled and stop the pool.
+
+        :return: Tuple (results, failures) like tiling.run_scenes
+        """
+        self.queue.put(None)
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        return self.results, self.failures
+
+
+def fetch_scene(download, args, catalog, manifest, params, tiler):
+    """
+    Download one scene and hand the tifs in it to the tiling stage.
+
+    :return: Tuple (bytes transferred, True if the scene was downloaded and queued), like
+             usgs_download.download_scene
+    """
+    with metrics.stage('disk-wait', scene=download['displayId']) as m:
+        m['wait_s'] = wait_for_disk(args.output_dir, args.min_free_gb)
+    nbytes, ok = usgs_download.download_scene(download, args.output_dir, verify_zip=args.verify_zip,
+                                              catalog=catalog, dataset=usgs_download.DATASET_NAME,
+                                              extract_dir=args.extract_dir)
+    zip_path = os.path.join(args.output_dir, download['displayId'] + '.zip')
+    if not ok or not os.path.exists(zip_path):
+        return nbytes, False
+    try:
+        scenes = zip_scenes(zip_path)
+    except zipfile.BadZipFile as e:
+        usgs_download.failure_download.append(download['displayId'])
+        print(f'{download["displayId"]} is not a readable zip ({e})')
+        return nbytes, False
+    raw_files = [zip_path]
+    if args.extract_dir is not None:
+        scenes = [(filename, os.path.join(args.extract_dir, filename)) for filename, _ in scenes]
+        scenes = [(filename, path) for filename, path in scenes if os.path.exists(path)]
+        raw_files += [path for _, path in scenes]
+    # scenes an earlier run (or filter.py --incremental) already tiled with the same settings
+    scenes = [(filename, path) for filename, path in scenes
+              if not manifest.is_current('filter', filename, scene_fingerprint(path), params,
+                                         npz_output(args.np_dir, filename))]
+    tiler.put(scenes, raw_files)
+    return nbytes, True
+
+
+def npz_output(np_dir, filename):
+    return os.path.join(np_dir, os.path.splitext(filename)[0] + '.npz')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    usgs_download.add_arguments(parser)
+    rgb_filter.add_tiling_arguments(parser)
+    parser.add_argument('--np_dir', type=str, required=True, help='The directory to store np array')
+    parser.add_argument('--tile_workers', type=int, default=os.cpu_count() or 1,
+                        help='number of scenes tiled in parallel')
+    parser.add_argument('--queue_size', type=int, default=None,
+                        help='downloaded scenes allowed to wait for a tiling worker (default: --tile_workers)')
+    parser.add_argument('--min_free_gb', type=float, default=0,
+                        help='hold new downloads while the download directory has less free space than this')
+    parser.add_argument('--delete_raw', action='store_true',
+                        help='remove each zip (and its extracted tifs) once all of its tifs are tiled')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help=f'sqlite manifest of the tiled scenes (default: <np_dir>/{MANIFEST_NAME})')
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure_from_args(args)
+
+    for directory in (args.output_dir, args.np_dir, args.extract_dir):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    service_url = args.service_url.rstrip("/") + "/"
+    usgs_download.configure_session(args.workers + 2)
+    with metrics.stage('login'):
+        api_key = usgs_download.login(service_url, args.username, args.password)
+
+    catalog = SceneCatalog(args.catalog or ':memory:')
+    manifest = TilingManifest(args.manifest or os.path.join(args.np_dir, MANIFEST_NAME))
+    params = rgb_filter.tiling_params(args)
+
+    def record(filename, path, tiles):
+        manifest.record('filter', filename, scene_fingerprint(path), params, npz_output(args.np_dir, filename), tiles)
+
+    tiler = TilingStage(partial(rgb_filter.process_scene, npz_path=args.np_dir, strip=args.strip,
+                                legacy_npz=args.legacy_npz, prescreen=args.prescreen,
+                                prescreen_overviews=args.prescreen_overviews,
+                                codec=args.codec, codec_threads=args.codec_threads),
+                        workers=args.tile_workers, queue_size=args.queue_size or args.tile_workers,
+                        gdal_cache_mb=args.gdal_cache_mb, delete_raw=args.delete_raw, on_done=record)
+    downloads = ThreadPoolExecutor(max_workers=args.workers)
+    futures = []
+    start_time = time.time()
+
+    def submit(download):
+        print("DOWNLOAD: " + download['url'])
+        futures.append(downloads.submit(fetch_scene, download, args, catalog, manifest, params, tiler))
+
+    try:
+        for dataset in usgs_download.search_datasets(service_url, api_key):
+            poller = usgs_download.DownloadPoller(service_url, usgs_download.LABEL, api_key, submit,
+                                                  max_wait=args.max_wait, min_interval=args.poll_interval)
+            usgs_download.order_scenes(service_url, api_key, dataset, poller, catalog, args.page_size,
+                                       args.batch_size, retry_failed=not args.skip_failed)
+        with metrics.stage('wait-transfers'):
+            usgs_download.wait_downloads(futures, start_time)
+    finally:
+        downloads.shutdown()
+        with metrics.stage('wait-tiling'):
+            results, failures = tiler.close()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f'Tiled {len(results)} scenes into {sum(results.values())} tiles in {elapsed:.1f} s')
+    for filename, error in failures:
+        print(f'{filename} failed: {error}')
+    for status, (count, size) in sorted(catalog.summary(usgs_download.DATASET_NAME).items()):
+        print(f"{status}: {count} scenes, {size / 1e9:.2f} GB")
+    catalog.close()
+    manifest.close()
+    usgs_download.logout(service_url, api_key)
+    metrics.finish()
+    return results, failures
+
+
+if __name__ == '__main__':
+    try:
+        _, failures = main()
+    except usgs_download.M2MError as e:
+        print(e)
+        sys.exit(1)
+    if failures or usgs_download.failure_download:
+        print(usgs_download.failure_download)
+        sys.exit(1)
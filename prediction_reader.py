@@ -0,0 +1,143 @@
+# Shared reader for the prediction .npz batches consumed by npz_to_shp.py and npz_to_tif.py.
+#
+# Each batch file holds 'batch_result', an object array of dicts with
+#   pred_mask   (h, w) or (1, h, w) mask, numpy array or torch tensor
+#   crop_info   dict of a, b, d, e, x_offset, y_offset, filename, crs (0-d numpy arrays)
+
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+import metrics
+
+
+def as_scalar(v):
+    # crop_info values are 0-d numpy arrays, but plain python values also work
+    return v.item() if isinstance(v, np.ndarray) else v
+
+
+def as_array(mask):
+    """A mask as a numpy array. CPU torch tensors are returned as a view (.numpy()), not copied."""
+    if hasattr(mask, 'detach'):
+        mask = mask.detach().cpu()
+    if hasattr(mask, 'numpy'):
+        mask = mask.numpy()
+    return mask
+
+
+def prediction_files(input_dir):
+    """Sorted paths of the .npz batch files in input_dir, so every run sees the same order."""
+    return [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir)) if f.endswith('.npz')]
+
+
+def iter_predictions(npz_path):
+    """
+    Yield (mask, crop_info) for every entry of one batch file.
+
+    Only the 'batch_result' member is read, never the other members of the archive, and the
+    entries are handed out one at a time so callers don't build a second copy of the batch.
+    """
+    for item in load_batch(npz_path):
+        b = dict(item)
+        yield as_array(b['pred_mask']), b['crop_info']
+
+
+def load_batch(npz_path):
+    # the object array of one batch file; it is pickled, so it can only be read whole
+    with np.load(npz_path, allow_pickle=True) as npz:
+        return npz['batch_result']
+
+
+# path and contents of the batch file iter_tiles read last in this process
+_last_batch = [None, None]
+
+
+def _cached_batch(npz_path):
+    if _last_batch[0] != npz_path:
+        # drop the previous batch before loading the next, so only one is ever held
+        _last_batch[:] = None, None
+        _last_batch[:] = npz_path, load_batch(npz_path)
+    return _last_batch[1]
+
+
+def _convert_file(convert, output_dir, npz_path):
+    # number of entries of one batch file passed to convert
+    count = 0
+    with metrics.stage('convert', file=os.path.basename(npz_path)) as m:
+        m['bytes_in'] = os.path.getsize(npz_path)
+        for mask, crop_info in iter_predictions(npz_path):
+            convert(mask, crop_info, output_dir)
+            count += 1
+        m['tiles'] = count
+    return count
+
+
+def convert_files(convert, input_dir, output_dir, workers=1):
+    """
+    Call convert(mask, crop_info, output_dir) for every prediction in input_dir.
+
+    With workers > 1 the batch files are spread over a process pool, one file per task, so at
+    most `workers` batches are in memory at once. Results come back in file order whatever
+    the pool does.
+
+    :param convert: Module-level function, so it can be sent to worker processes
+    :return: List of (npz path, number of predictions converted), in sorted file order
+    """
+    files = prediction_files(input_dir)
+    if workers <= 1:
+        counts = [_convert_file(convert, output_dir, f) for f in tqdm(files)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(tqdm(executor.map(_convert_file, [convert] * len(files), [output_dir] * len(files), files),
+                               total=len(files)))
+    return list(zip(files, counts))
+
+
+def scene_tiles(input_dir):
+    """
+    References to the predictions of input_dir keyed by the scene they were cropped from.
+
+    Only the crop_info of each entry is kept, the masks are dropped as soon as each batch file
+    has been read, so this pass holds one batch at a time whatever the size of the corpus.
+
+    :return: Dict of crop_info['filename'] -> list of (npz path, entry index, crop_info), in file order
+    """
+    scenes = defaultdict(list)
+    for npz_path in prediction_files(input_dir):
+        for k, (_, crop_info) in enumerate(iter_predictions(npz_path)):
+            scenes[as_scalar(crop_info['filename'])].append((npz_path, k, crop_info))
+    return scenes
+
+
+def iter_tiles(refs):
+    """
+    Yield (mask, crop_info) for tile references of scene_tiles, reading the masks back from disk.
+
+    The batch file read last is kept (one per process) and dropped before the next one is
+    loaded, so at most one batch is in memory. A scene's references are in file order, so each
+    of its batch files is read once, and consecutive scenes share the batch they both touch.
+    Batch files are pickled and can only be read whole, though: when scenes are interleaved
+    across batches, a batch is read once for every scene it holds tiles of.
+    """
+    for npz_path, k, crop_info in refs:
+        yield as_array(dict(_cached_batch(npz_path)[k])['pred_mask']), crop_info
+
+
+def convert_scenes(convert_scene, scenes, output_dir, workers=1, **options):
+    """
+    Call convert_scene(filename, tiles, output_dir, **options) for every scene of scene_tiles.
+
+    Scenes run in sorted order, spread over a process pool when workers > 1. Only the tile
+    references are sent to the workers, which read the masks themselves with iter_tiles.
+
+    :return: List of the return values of convert_scene, in sorted scene order
+    """
+    names = sorted(scenes)
+    if workers <= 1:
+        return [convert_scene(name, scenes[name], output_dir, **options) for name in tqdm(names)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_scene, name, scenes[name], output_dir, **options) for name in names]
+        return [future.result() for future in tqdm(futures)]
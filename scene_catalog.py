@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+
+# status of a scene as it moves through search -> request -> download
+FOUND = 'found'
+REQUESTED = 'requested'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    dataset TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    display_id TEXT,
+    product_id TEXT,
+    download_id TEXT,
+    status TEXT NOT NULL DEFAULT 'found',
+    filesize INTEGER,
+    acquisition_date TEXT,
+    path TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL,
+    PRIMARY KEY (dataset, entity_id)
+);
+CREATE INDEX IF NOT EXISTS scenes_display_id ON scenes (dataset, display_id);
+CREATE INDEX IF NOT EXISTS scenes_status ON scenes (dataset, status);
+'''
+
+
+class SceneCatalog:
+    """SQLite record of every scene seen by usgs-download.py, keyed by (dataset, entityId).
+
+    The search, request and download stages all write to it, so a later run can skip
+    scenes that are already downloaded and retry only the ones that failed. Writes come
+    from the download threads as well as the main thread, so they are serialized with a lock.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # upsert scene-search results without touching the status of known scenes
+    def record_scenes(self, dataset, results):
+        now = time.time()
+        rows = []
+        for result in results:
+            coverage = result.get('temporalCoverage') or {}
+            acquisition_date = coverage.get('startDate') or result.get('acquisitionDate')
+            rows.append((dataset, result['entityId'], result.get('displayId'), acquisition_date, now))
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO scenes (dataset, entity_id, display_id, acquisition_date, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (dataset, entity_id) DO UPDATE SET
+                    display_id = COALESCE(excluded.display_id, display_id),
+                    acquisition_date = COALESCE(excluded.acquisition_date, acquisition_date)
+            ''', rows)
+
+    # store product id and size from download-options
+    def record_options(self, dataset, options):
+        rows = [(product['id'], product.get('filesize'), dataset, product['entityId'])
+                for product in options if product['available']]
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                UPDATE scenes SET product_id = ?, filesize = COALESCE(?, filesize)
+                WHERE dataset = ? AND entity_id = ?
+            ''', rows)
+
+    # entity ids that still need to be requested, in their original order
+    def pending(self, dataset, entity_ids, retry_failed=True):
+        skip = {DOWNLOADED} if retry_failed else {DOWNLOADED, FAILED}
+        with self.lock:
+            done = set()
+            for batch_start in range(0, len(entity_ids), 500):
+                batch = entity_ids[batch_start:batch_start + 500]
+                marks = ','.join('?' * len(batch))
+                statuses = ','.join('?' * len(skip))
+                done.update(row[0] for row in self.conn.execute(
+                    f'SELECT entity_id FROM scenes WHERE dataset = ? AND entity_id IN ({marks}) '
+                    f'AND status IN ({statuses})', [dataset, *batch, *skip]))
+        return [entity_id for entity_id in entity_ids if entity_id not in done]
+
+    def set_status(self, dataset, entity_ids, status, error=None):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                UPDATE scenes SET status = ?, error = ?, updated_at = ?,
+                    attempts = attempts + (? = 'failed')
+                WHERE dataset = ? AND entity_id = ?
+            ''', [(status, error, now, status, dataset, entity_id) for entity_id in entity_ids])
+
+    # record the outcome of one download, matched on entityId or displayId
+    def record_download(self, dataset, download, status, path=None, error=None):
+        entity_id = download.get('entityId')
+        key_column, key = ('entity_id', entity_id) if entity_id else ('display_id', download.get('displayId'))
+        with self.lock, self.conn:
+            self.conn.execute(f'''
+                UPDATE scenes SET status = ?, download_id = ?, path = COALESCE(?, path), error = ?,
+                    updated_at = ?, attempts = attempts + (? = 'failed')
+                WHERE dataset = ? AND {key_column} = ?
+            ''', (status, str(download.get('downloadId')), path, error, time.time(), status, dataset, key))
+
+    # per-status scene counts and bytes, e.g. for a summary at the end of a run
+    def summary(self, dataset):
+        with self.lock:
+            return {status: (count, size or 0) for status, count, size in self.conn.execute(
+                'SELECT status, COUNT(*), SUM(filesize) FROM scenes WHERE dataset = ? GROUP BY status',
+                (dataset,))}
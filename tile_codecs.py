@@ -0,0 +1,145 @@
+# Compression codecs for the tile archives of tile_store.py.
+#
+# Tiles are compressed one by one (a chunk per tile) so a reader can still decode any single
+# tile without touching the others, and so encoding spreads over threads: zlib, lz4 and zstd
+# all release the GIL while they work. lz4 and zstandard are optional imports, only needed
+# when that codec is used.
+
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ('none', 'zlib', 'lz4', 'zstd')
+DEFAULT_LEVELS = {'none': 0, 'zlib': 6, 'lz4': 0, 'zstd': 3}
+
+
+def parse_codec(spec):
+    """
+    Parse a codec spec like 'zstd', 'zstd:9' or 'zlib:1'.
+
+    :return: Tuple (codec name, level)
+    """
+    name, _, level = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f'unknown codec {name}, expected one of {CODECS}')
+    if name == 'lz4' and lz4 is None:
+        raise ImportError('the lz4 codec needs the lz4 package (pip install lz4)')
+    if name == 'zstd' and zstandard is None:
+        raise ImportError('the zstd codec needs the zstandard package (pip install zstandard)')
+    return name, int(level) if level else DEFAULT_LEVELS[name]
+
+
+def compress(codec, level, buf):
+    if codec == 'none':
+        return bytes(buf)
+    if codec == 'zlib':
+        return zlib.compress(buf, level)
+    if codec == 'lz4':
+        return lz4.frame.compress(buf, compression_level=level)
+    # a ZstdCompressor is not thread safe, so each call gets its own
+    return zstandard.ZstdCompressor(level=level).compress(buf)
+
+
+def decompress(codec, payload):
+    if codec == 'none':
+        return bytes(payload)
+    if codec == 'zlib':
+        return zlib.decompress(payload)
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ImportError('this archive is lz4 compressed, pip install lz4 to read it')
+        return lz4.frame.decompress(payload)
+    if zstandard is None:
+        raise ImportError('this archive is zstd compressed, pip install zstandard to read it')
+    return zstandard.ZstdDecompressor().decompress(payload)
+
+
+def encode_chunks(data, codec, level, threads=None):
+    """
+    Compress every data[k] separately, on a pool of threads.
+
+    :param data: Array of shape (N, ...), one chunk per first-axis entry
+    :param threads: Encoder threads, default one per CPU
+    :return: Tuple (payload, offsets): all chunks back to back as a uint8 array, and the N + 1
+             offsets of the chunk boundaries in it
+    """
+    threads = threads or os.cpu_count() or 1
+    views = [np.ascontiguousarray(tile) for tile in data]
+    if threads > 1 and len(views) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            chunks = list(executor.map(lambda tile: compress(codec, level, memoryview(tile).cast('B')), views))
+    else:
+        chunks = [compress(codec, level, memoryview(tile).cast('B')) for tile in views]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in chunks], out=offsets[1:])
+    payload = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+    return payload, offsets
+
+
+class CompressedTiles:
+    """
+    Read-only, array-like view of per-tile compressed chunks.
+
+    Indexing with an int decodes only that tile; slices, fancy indexes and np.asarray decode the
+    tiles they cover (in parallel threads when there are several).
+    """
+
+    def __init__(self, payload, offsets, shape, dtype, codec, threads=None):
+        self.payload = payload
+        self.offsets = offsets
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.threads = threads or os.cpu_count() or 1
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decode(self, k):
+        chunk = self.payload[self.offsets[k]:self.offsets[k + 1]]
+        return np.frombuffer(decompress(self.codec, chunk), dtype=self.dtype).reshape(self.shape[1:])
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            # decode the tiles picked by the first index, then apply the rest to them
+            first, rest = index[0], index[1:]
+            if isinstance(first, (int, np.integer)):
+                return self[first][rest]
+            return self[first][(slice(None),) + rest]
+        if isinstance(index, (int, np.integer)):
+            k = int(index)
+            if k < 0:
+                k += len(self)
+            if not 0 <= k < len(self):
+                raise IndexError(f'tile {index} out of range for {len(self)} tiles')
+            return self._decode(k)
+        keys = np.arange(len(self))[index]
+        out = np.empty((len(keys),) + self.shape[1:], dtype=self.dtype)
+        if self.threads > 1 and len(keys) > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                for i, tile in enumerate(executor.map(self._decode, keys.tolist())):
+                    out[i] = tile
+        else:
+            for i, k in enumerate(keys.tolist()):
+                out[i] = self._decode(k)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
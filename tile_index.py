@@ -0,0 +1,134 @@
+# Global index over every tile in a directory of per-scene .npz archives, and a lazy
+# random-access dataset on top of it for shuffling tiles across scenes during training.
+#
+# Usage: python tile_index.py --npz_dir /path/to/npz --manifest /path/to/manifest.npz
+#
+#   from tile_index import TileDataset
+#   dataset = TileDataset('/path/to/manifest.npz')
+#   tile, info = dataset[k]
+#
+# The manifest is itself a small pickle-free .npz with one row per tile:
+#   file_index, tile_index, x_offset, y_offset, row, col, score, plus the list of files
+# TileDataset implements __len__/__getitem__, so it can be wrapped by a torch DataLoader.
+
+import argparse
+import os
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+from tile_store import load_tiles
+
+COLUMNS = ('x_offset', 'y_offset', 'row', 'col', 'score')
+
+
+def _tile_columns(npz_path):
+    # per-tile metadata of one archive without touching the tile pixels, None if it is not
+    # a tile archive (e.g. a manifest or prediction batch saved in the same directory)
+    with np.load(npz_path, allow_pickle=False) as npz:
+        legacy = 'accumulated_results' in npz.files
+        if not legacy:
+            if 'format_version' not in npz.files or not {'data', 'data_chunks'} & set(npz.files):
+                return None
+            columns = {key: npz[key] for key in COLUMNS if key in npz.files}
+    if legacy:
+        store = load_tiles(npz_path)
+        columns = {key: store[key] for key in COLUMNS}
+    if 'score' not in columns:
+        columns['score'] = np.full(len(columns['x_offset']), np.nan, dtype=np.float32)
+    return columns
+
+
+def build_manifest(npz_dir, manifest_path=None):
+    """
+    Scan npz_dir once and record every tile it contains.
+
+    :param npz_dir: Directory of .npz files from filter.py / filter_greyscale.py
+    :param manifest_path: Where to save the manifest, or None to only return it
+    :return: Dict of 1-d arrays with one entry per tile (file_index, tile_index, x_offset,
+             y_offset, row, col, score) plus 'files', the archive paths relative to npz_dir
+    """
+    # a manifest saved into npz_dir by an earlier build is not an archive to index
+    skip = None
+    if manifest_path is not None:
+        # np.savez adds the extension when it is missing
+        skip = os.path.abspath(manifest_path if manifest_path.endswith('.npz') else manifest_path + '.npz')
+    candidates = sorted(f for f in os.listdir(npz_dir)
+                        if f.endswith('.npz') and os.path.abspath(os.path.join(npz_dir, f)) != skip)
+    files = []
+    parts = {key: [] for key in ('file_index', 'tile_index') + COLUMNS}
+    for f in tqdm(candidates):
+        columns = _tile_columns(os.path.join(npz_dir, f))
+        if columns is None:
+            print(f'skipping {f}, not a tile archive')
+            continue
+        file_index = len(files)
+        files.append(f)
+        n = len(columns['x_offset'])
+        parts['file_index'].append(np.full(n, file_index, dtype=np.int32))
+        parts['tile_index'].append(np.arange(n, dtype=np.int32))
+        for key in COLUMNS:
+            parts[key].append(columns[key])
+    manifest = {key: np.concatenate(values) if values else np.empty(0) for key, values in parts.items()}
+    manifest['files'] = np.array(files, dtype=str)
+    if manifest_path is not None:
+        np.savez(manifest_path, root=np.array(os.path.abspath(npz_dir)), **manifest)
+    return manifest
+
+
+class TileDataset:
+    """
+    Random access to any tile listed in a manifest, opening archives only when needed.
+
+    Archives are opened with tile_store.load_tiles (memory-mapped when uncompressed), and at
+    most cache_size of them stay open, evicting the least recently used. Start-up cost and
+    memory therefore do not grow with the size of the corpus.
+    """
+
+    def __init__(self, manifest_path, npz_dir=None, cache_size=16, min_score=None):
+        with np.load(manifest_path, allow_pickle=False) as manifest:
+            self.root = npz_dir or str(manifest['root'])
+            self.files = [str(f) for f in manifest['files']]
+            self.columns = {key: manifest[key] for key in ('file_index', 'tile_index') + COLUMNS}
+        if min_score is not None:
+            keep = self.columns['score'] >= min_score
+            self.columns = {key: values[keep] for key, values in self.columns.items()}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.columns['file_index'])
+
+    def _open(self, file_index):
+        store = self.cache.get(file_index)
+        if store is None:
+            store = load_tiles(os.path.join(self.root, self.files[file_index]))
+            self.cache[file_index] = store
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(file_index)
+        return store
+
+    def __getitem__(self, k):
+        """
+        :return: Tuple (tile, info): the (bands, h, w) tile, a view into the memory-mapped
+                 archive where possible, and a dict with its scene, offsets and score
+        """
+        file_index = int(self.columns['file_index'][k])
+        store = self._open(file_index)
+        tile = store['data'][int(self.columns['tile_index'][k])]
+        info = {key: self.columns[key][k].item() for key in COLUMNS}
+        info['filename'] = store['filename']
+        info['npz_file'] = self.files[file_index]
+        return tile, info
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--npz_dir', type=str, required=True, help='directory of npz files to index')
+    parser.add_argument('--manifest', type=str, required=True, help='path of the manifest npz to write')
+    args = parser.parse_args()
+    manifest = build_manifest(args.npz_dir, args.manifest)
+    print(f"indexed {len(manifest['file_index'])} tiles in {len(manifest['files'])} files")
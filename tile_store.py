@@ -0,0 +1,211 @@
+# Pickle-free, memory-mappable layout for the per-scene tile archives written by
+# filter.py and filter_greyscale.py.
+#
+# Each <src_name>.npz is written with np.savez (members stored, not compressed) and holds
+#   data       (N, bands, h, w) uint8   all kept tiles in one contiguous array
+#   x_offset   (N,) float64             geographic x of each tile's top-left pixel centre
+#   y_offset   (N,) float64             geographic y of each tile's top-left pixel centre
+#   row, col   (N,) int32               pixel position of each tile in the source scene
+#   score      (N,) float32             selection score (NDWI / centerline sum), NaN if unknown
+#   transform  (6,) float64             scene transform a, b, c, d, e, f
+#   crs        str                      scene CRS as WKT
+#   filename   str                      source tif name
+#   a, b, d, e, count                   scalars kept for scripts that read the old layout
+#   format_version                      TILE_FORMAT_VERSION
+#
+# Nothing needs allow_pickle, and because 'data' is stored uncompressed load_tiles can memory-map
+# it straight out of the zip, so reading tile k touches only that tile's bytes.
+#
+# With a codec other than 'none' (see tile_codecs.py), 'data' is replaced by
+#   data_chunks   (M,) uint8            every tile compressed on its own, back to back
+#   data_offsets  (N + 1,) int64        start of each tile's chunk in data_chunks
+#   data_shape, data_dtype              shape and dtype of the decoded 'data'
+#   codec, codec_level                  how the chunks were compressed
+# and load_tiles returns a tile_codecs.CompressedTiles as 'data', which decodes tiles on access.
+#
+# Usage (convert old pickled archives, or recompress):
+#   python tile_store.py --input_dir old_npz --output_dir new_npz [--codec zstd:3]
+
+import argparse
+import os
+import struct
+import zipfile
+
+import numpy as np
+from tqdm import tqdm
+
+from tile_codecs import CODECS, CompressedTiles, encode_chunks, parse_codec
+
+TILE_FORMAT_VERSION = 2
+LEGACY_FORMAT_VERSION = 1
+
+
+def _write_store(npz_file, data, codec='none', threads=None, **fields):
+    # np.savez the columnar layout, with 'data' plain or as compressed per-tile chunks
+    codec, level = parse_codec(codec)
+    if codec == 'none':
+        fields['data'] = data
+    else:
+        payload, offsets = encode_chunks(data, codec, level, threads)
+        fields.update(data_chunks=payload, data_offsets=offsets, data_shape=np.array(data.shape, dtype=np.int64),
+                      data_dtype=np.array(data.dtype.str), codec=np.array(codec), codec_level=level)
+    np.savez(npz_file, format_version=TILE_FORMAT_VERSION, **fields)
+
+
+def save_tiles(npz_file, src, filename, results, h=512, w=512, codec='none', threads=None):
+    """
+    Save the tiles of one scene in the columnar layout.
+
+    :param npz_file: Output path
+    :param src: Open rasterio dataset the tiles were cropped from
+    :param filename: Source tif name stored with the tiles
+    :param results: List of tile_record dicts (data, crs, x_offset, y_offset)
+    :param codec: 'none' (memory-mappable), or 'zlib', 'lz4', 'zstd' with an optional ':level'
+    :param threads: Compression threads, default one per CPU
+    """
+    if results:
+        data = np.stack([r['data'] for r in results])
+    else:
+        data = np.zeros((0, src.count, h, w), dtype=src.dtypes[0])
+    x_offset = np.array([r['x_offset'] for r in results], dtype=np.float64)
+    y_offset = np.array([r['y_offset'] for r in results], dtype=np.float64)
+    # x/y_offset are pixel centres (src.xy), so index() maps them back to the exact pixel
+    positions = [src.index(x, y) for x, y in zip(x_offset, y_offset)]
+    row = np.array([p[0] for p in positions], dtype=np.int32)
+    col = np.array([p[1] for p in positions], dtype=np.int32)
+    score = np.array([r.get('score', np.nan) for r in results], dtype=np.float32)
+    t = src.transform
+    _write_store(npz_file, data, codec, threads,
+                 x_offset=x_offset, y_offset=y_offset, row=row, col=col, score=score,
+                 transform=np.array([t.a, t.b, t.c, t.d, t.e, t.f], dtype=np.float64),
+                 crs=np.array(src.crs.to_wkt() if src.crs else ''), filename=np.array(filename),
+                 a=t.a, b=t.b, d=t.d, e=t.e, count=src.count)
+
+
+def _memmap_member(npz_path, name):
+    # memory-map an uncompressed .npy member of a zip, None if it is compressed
+    with zipfile.ZipFile(npz_path) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(npz_path, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(npz_path, dtype=dtype, mode='r', shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+
+def _load_legacy(npz):
+    # accumulated_results is an object array of dicts, which needs allow_pickle
+    records = npz['accumulated_results']
+    count = int(npz['count'])
+    a, b, d, e = (float(npz[k]) for k in 'abde')
+    if len(records):
+        data = np.stack([r['data'] for r in records])
+        crs = records[0]['crs']
+        crs = crs.to_wkt() if crs is not None else ''
+    else:
+        data = np.zeros((0, count, 512, 512), dtype=np.uint8)
+        crs = ''
+    x_offset = np.array([r['x_offset'] for r in records], dtype=np.float64)
+    y_offset = np.array([r['y_offset'] for r in records], dtype=np.float64)
+    # the old layout has no scene origin, tile positions are relative to the first tile
+    x0 = x_offset.min() if len(records) else 0.0
+    y0 = y_offset.max() if len(records) else 0.0
+    col = np.rint((x_offset - x0) / a).astype(np.int32) if a else np.zeros(len(records), np.int32)
+    row = np.rint((y_offset - y0) / e).astype(np.int32) if e else np.zeros(len(records), np.int32)
+    score = np.array([r.get('score', np.nan) for r in records], dtype=np.float32)
+    return {'format_version': LEGACY_FORMAT_VERSION, 'data': data,
+            'x_offset': x_offset, 'y_offset': y_offset, 'row': row, 'col': col, 'score': score,
+            'transform': np.array([a, b, x0 - a / 2 - b / 2, d, e, y0 - d / 2 - e / 2]),
+            'crs': crs, 'filename': str(npz['filename']), 'count': count}
+
+
+def load_tiles(npz_path, mmap=True):
+    """
+    Load a scene's tile archive, in either the columnar or the old pickled layout.
+
+    :param npz_path: Path to a .npz written by filter.py or filter_greyscale.py
+    :param mmap: Memory-map 'data' (or the compressed chunks) instead of reading it, when the
+                 archive members are stored uncompressed
+    :return: Dict with data, x_offset, y_offset, row, col, score, transform, crs (WKT), filename,
+             count, codec and format_version. Old archives are converted in memory. For
+             compressed archives 'data' is a CompressedTiles that decodes tiles on access.
+    """
+    with np.load(npz_path, allow_pickle=False) as npz:
+        if 'accumulated_results' in npz.files:
+            legacy = True
+        else:
+            legacy = False
+            store = {key: npz[key] for key in npz.files if key not in ('data', 'data_chunks')}
+    if legacy:
+        with np.load(npz_path, allow_pickle=True) as npz:
+            store = _load_legacy(npz)
+        store['codec'] = 'none'
+        return store
+
+    codec = str(store.pop('codec', 'none'))
+    member = 'data' if codec == 'none' else 'data_chunks'
+    data = _memmap_member(npz_path, member) if mmap else None
+    if data is None:
+        with np.load(npz_path) as npz:
+            data = npz[member]
+    if codec != 'none':
+        data = CompressedTiles(data, store.pop('data_offsets'), store.pop('data_shape'),
+                               str(store.pop('data_dtype')), codec)
+        store.pop('codec_level', None)
+    store['data'] = data
+    store['codec'] = codec
+    store['format_version'] = int(store['format_version'])
+    store['crs'] = str(store['crs'])
+    store['filename'] = str(store['filename'])
+    store['count'] = int(store['count'])
+    if 'score' not in store:
+        store['score'] = np.full(len(store['x_offset']), np.nan, dtype=np.float32)
+    return store
+
+
+def tile_records(store):
+    """Per-tile dicts (data, crs, x_offset, y_offset) like the old accumulated_results entries."""
+    for k in range(len(store['data'])):
+        yield {'data': store['data'][k], 'crs': store['crs'],
+               'x_offset': float(store['x_offset'][k]), 'y_offset': float(store['y_offset'][k])}
+
+
+def migrate(npz_path, output_path, codec='none', threads=None):
+    """Rewrite an archive (old pickled layout or any codec) in the columnar layout with codec."""
+    store = load_tiles(npz_path)
+    t = store['transform']
+    _write_store(output_path, np.asarray(store['data']), codec, threads,
+                 x_offset=store['x_offset'], y_offset=store['y_offset'],
+                 row=store['row'], col=store['col'], score=store['score'], transform=t, crs=np.array(store['crs']),
+                 filename=np.array(store['filename']), a=t[0], b=t[1], d=t[3], e=t[4], count=store['count'])
+
+
+def add_codec_arguments(parser):
+    """Add --codec and --codec_threads, shared by every script that writes tile archives."""
+    parser.add_argument('--codec', type=str, default='none',
+                        help=f'tile compression, one of {", ".join(CODECS)} with an optional :level, e.g. zstd:3')
+    parser.add_argument('--codec_threads', type=int, default=None, help='compression threads (default: one per CPU)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True, help='directory of npz files in the old layout')
+    parser.add_argument('--output_dir', type=str, required=True, help='directory to write the converted npz files')
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for f in tqdm(sorted(os.listdir(args.input_dir))):
+        if f.endswith('.npz'):
+            migrate(os.path.join(args.input_dir, f), os.path.join(args.output_dir, f), args.codec, args.codec_threads)
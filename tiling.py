@@ -0,0 +1,341 @@
+# Helpers shared by filter.py and filter_greyscale.py
+import os
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm
+from rasterio.windows import Window
+from work_queue import WorkQueue, split_units
+
+TIF_EXTENSIONS = ('.tif', '.tiff')
+
+def list_scenes(input_dir):
+    """
+    List every GeoTIFF in input_dir, including the ones still inside downloaded .zip archives.
+
+    Zipped GeoTIFFs are opened in place through GDAL's /vsizip/ filesystem, so tiling can run
+    on usgs-download.py output without a separate unzip pass. When a scene exists both as an
+    extracted .tif and inside a zip, the extracted file is used.
+
+    :param input_dir: Directory holding .tif files and/or .zip archives
+    :return: Sorted list of (filename, path) where path can be passed to rasterio.open
+    """
+    scenes = {}
+    zipped = {}
+    for filename in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, filename)
+        lower = filename.lower()
+        if lower.endswith(TIF_EXTENSIONS):
+            scenes[filename] = path
+        elif lower.endswith('.zip'):
+            try:
+                members = zip_scenes(path)
+            except zipfile.BadZipFile:
+                print(f'skipping unreadable zip {path}')
+                continue
+            for member, member_path in members:
+                zipped.setdefault(member, member_path)
+    for filename, path in zipped.items():
+        scenes.setdefault(filename, path)
+    return sorted(scenes.items())
+
+def zip_scenes(zip_path):
+    """
+    The GeoTIFFs inside one zip, as /vsizip/ paths rasterio can open without extracting them.
+
+    :return: List of (filename, path)
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        members = [name for name in zf.namelist() if name.lower().endswith(TIF_EXTENSIONS)]
+    return [(os.path.basename(member), f'/vsizip/{os.path.abspath(zip_path)}/{member}') for member in members]
+
+def block_strips(src, min_rows=256):
+    """
+    Full-width row strips aligned to the raster's native block rows.
+
+    Each strip covers whole blocks (one or more block rows, at least min_rows rows), so every
+    block is decoded exactly once and only one strip has to be held in memory at a time.
+
+    :param src: Open rasterio dataset
+    :param min_rows: Smallest strip height for rasters stored in thin strips
+    :return: Generator of rasterio Windows from top to bottom
+    """
+    block_h = src.block_shapes[0][0]
+    step = block_h * max(1, -(-min_rows // block_h))
+    for row in range(0, src.height, step):
+        yield Window(0, row, src.width, min(step, src.height - row))
+
+def tile_starts(size, tile):
+    """
+    Start offsets of tiles along one axis, same grid as the original sliding_crop loops.
+
+    Tiles are laid edge to edge from 0, and when size is not a multiple of tile one more tile
+    is added flush with the far edge (overlapping its neighbour). No tiles fit if size < tile.
+    """
+    if size < tile:
+        return np.empty(0, dtype=np.int64)
+    starts = np.arange(0, size - tile + 1, tile)
+    if size % tile:
+        starts = np.append(starts, size - tile)
+    return starts
+
+def tile_grid(height, width, h=512, w=512):
+    """
+    Top-left (row, col) of every tile of a height x width scene, in row-major order.
+
+    :return: Tuple of two 1-d int arrays (rows, cols)
+    """
+    rows, cols = np.meshgrid(tile_starts(height, h), tile_starts(width, w), indexing='ij')
+    return rows.ravel(), cols.ravel()
+
+def _prefix_sums(a, positions, axis):
+    # sum of a over [0, p) along axis for every p in positions (each within [0, n])
+    # one np.add.reduceat pass over the segments between the distinct positions
+    n = a.shape[axis]
+    points = np.unique(np.concatenate(([0], positions)))
+    segments = points[points < n]
+    acc_dtype = np.float64 if np.issubdtype(a.dtype, np.floating) else np.int64
+    sums = np.cumsum(np.add.reduceat(a, segments, axis=axis, dtype=acc_dtype), axis=axis)
+    zero_shape = list(sums.shape)
+    zero_shape[axis] = 1
+    values = np.concatenate((np.zeros(zero_shape, dtype=acc_dtype), sums), axis=axis)
+    index = np.searchsorted(np.append(segments, n), positions)
+    return np.take(values, index, axis=axis)
+
+def window_sums(mask, top, left, bottom, right):
+    """
+    Sum of mask[top:bottom, left:right] for many windows at once.
+
+    Builds a summed-area table only at the distinct window edges: one reduce over the rows,
+    then one over the columns of that much smaller array. Each window is then O(1), no matter
+    how large it is or how much windows overlap.
+
+    :param mask: 2-d array
+    :param top, left, bottom, right: 1-d int arrays of window bounds, clipped to the mask
+    :return: 1-d array with one sum per window
+    """
+    rows = np.unique(np.concatenate((top, bottom)))
+    cols = np.unique(np.concatenate((left, right)))
+    table = _prefix_sums(_prefix_sums(mask, rows, 0), cols, 1)
+    r0, r1 = np.searchsorted(rows, top), np.searchsorted(rows, bottom)
+    c0, c1 = np.searchsorted(cols, left), np.searchsorted(cols, right)
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+def select_tiles(mask, h=512, w=512, min_sum=100, pad=0, return_scores=False):
+    """
+    Tiles of the sliding_crop grid whose (padded) window of mask sums to more than min_sum.
+
+    Replaces calling check_ndwi_sum once per tile. With pad, the window matches
+    filter_greyscale.check_ndwi_sum: it starts pad rows/cols before the tile (clipped at 0)
+    and spans h + pad by w + pad, clipped to the mask.
+
+    :param mask: 2-d selection mask (NDWI water mask or rasterized centerlines)
+    :param h: Height of a tile
+    :param w: Width of a tile
+    :param min_sum: A tile is kept if its window sum is strictly greater than this
+    :param pad: Extra context rows/cols included in the window
+    :param return_scores: Also return the window sum of every kept tile
+    :return: Tuple of two 1-d int arrays (rows, cols) of the kept tiles, in row-major order,
+             plus their window sums when return_scores is set
+    """
+    height, width = mask.shape
+    rows, cols = tile_grid(height, width, h, w)
+    if rows.size == 0:
+        return (rows, cols, np.empty(0)) if return_scores else (rows, cols)
+    top = np.maximum(rows - pad, 0)
+    left = np.maximum(cols - pad, 0)
+    bottom = np.minimum(top + h + pad, height)
+    right = np.minimum(left + w + pad, width)
+    sums = window_sums(mask, top, left, bottom, right)
+    keep = sums > min_sum
+    if return_scores:
+        return rows[keep], cols[keep], sums[keep]
+    return rows[keep], cols[keep]
+
+def tile_record(src, i_c, j_c, data, score=None):
+    """
+    One entry of the accumulated_results list saved to the scene's .npz.
+
+    :param src: Open rasterio dataset the tile comes from
+    :param i_c: Row index of the tile's top-left pixel
+    :param j_c: Column index of the tile's top-left pixel
+    :param data: Tile pixels of shape (bands, h, w)
+    :param score: Selection score of the tile (NDWI / centerline sum), if known
+    """
+    # Compute the top left geographic (x, y) coordinates of the cropped TIFF
+    x_offset, y_offset = src.xy(i_c, j_c)
+    record = {
+            'data': data,
+            'crs': src.crs,
+            'x_offset': x_offset,
+            'y_offset': y_offset
+    }
+    if score is not None:
+        record['score'] = float(score)
+    return record
+
+def read_tiles(src, rows, cols, h=512, w=512, strip=False):
+    """
+    Pixels of the given tiles, decoding every pixel of the scene at most once.
+
+    By default the whole scene is read in one call and each tile is a view into that buffer.
+    With strip=True only the strip of rows under each tile row is held at a time, and tiles
+    are copied out of it so the strip can be freed; memory is then bounded by one strip plus
+    the kept tiles, for scenes that do not fit in RAM.
+
+    :param src: Open rasterio dataset
+    :param rows, cols: Top-left pixel of every tile, e.g. from select_tiles
+    :return: Generator of (i_c, j_c, data) in the order of rows/cols
+    """
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    if rows.size == 0:
+        return
+    if not strip:
+        data = src.read()
+        for i_c, j_c in zip(rows.tolist(), cols.tolist()):
+            yield i_c, j_c, data[:, i_c:i_c + h, j_c:j_c + w]
+        return
+    order = np.argsort(rows, kind='stable')
+    for i_c in np.unique(rows).tolist():
+        data = src.read(window=Window(0, i_c, src.width, h))
+        for j_c in cols[order][rows[order] == i_c].tolist():
+            yield i_c, j_c, data[:, :, j_c:j_c + w].copy()
+
+def scene_size(path):
+    """Size in bytes of a scene on disk, looking inside the zip for /vsizip/ paths."""
+    if path.startswith('/vsizip/'):
+        zip_path, _, member = path[len('/vsizip/'):].partition('.zip/')
+        with zipfile.ZipFile(zip_path + '.zip') as zf:
+            return zf.getinfo(member).file_size
+    return os.path.getsize(path)
+
+def _init_worker(gdal_cache_mb):
+    # every worker gets its own, smaller GDAL block cache so N workers don't claim N x the default
+    os.environ['GDAL_CACHEMAX'] = str(gdal_cache_mb)
+
+def run_scenes(process_scene, scenes, workers=1, gdal_cache_mb=256, on_done=None):
+    """
+    Run process_scene(filename, path) for every scene, optionally in a pool of processes.
+
+    Scenes are submitted largest first, so a big scene does not start last and hold up the
+    batch. An exception in one scene is recorded and the rest of the batch carries on.
+
+    :param process_scene: Picklable function (module level, or a functools.partial of one)
+    :param scenes: List of (filename, path), e.g. from list_scenes
+    :param workers: Number of processes, 1 runs everything in this process
+    :param gdal_cache_mb: GDAL_CACHEMAX of each worker process
+    :param on_done: Called as on_done(filename, result) in this process as soon as a scene succeeds
+    :return: Tuple (results, failures): dict filename -> return value of process_scene,
+             and a list of (filename, error message) for the scenes that raised
+    """
+    scenes = sorted(scenes, key=lambda scene: scene_size(scene[1]), reverse=True)
+    results = {}
+    failures = []
+    if workers <= 1:
+        for filename, path in tqdm(scenes):
+            try:
+                results[filename] = process_scene(filename, path)
+            except Exception as e:
+                failures.append((filename, repr(e)))
+                continue
+            if on_done is not None:
+                on_done(filename, results[filename])
+        return results, failures
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(gdal_cache_mb,)) as executor:
+        futures = {executor.submit(process_scene, filename, path): filename for filename, path in scenes}
+        with tqdm(total=len(futures)) as progress:
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    results[filename] = future.result()
+                except Exception as e:
+                    failures.append((filename, repr(e)))
+                else:
+                    if on_done is not None:
+                        on_done(filename, results[filename])
+                progress.update(1)
+    return results, failures
+
+def run_scene_queue(process_scene, scenes, queue_dir, unit_size=10, lease_seconds=600, **options):
+    """
+    run_scenes over the work units this node leases from a queue shared with other nodes.
+
+    The first node to start splits scenes into units of unit_size; every node then claims
+    units until none are left, and a unit leased by a node that died is redone by another one
+    once its lease expires (see work_queue.py). A unit is completed once, when all of its scenes
+    succeeded; a unit with failed scenes is released and retried, at most max_attempts times.
+
+    :param queue_dir: Queue directory on a filesystem all nodes share
+    :param options: workers, gdal_cache_mb and on_done, as for run_scenes
+    :return: Tuple (results, failures) of the units this node processed
+    """
+    queue = WorkQueue(queue_dir, lease_seconds)
+    queue.plan(split_units([list(scene) for scene in scenes], unit_size))
+    results = {}
+    failures = {}   # filename -> error of its latest attempt
+    for lease in queue.leases():
+        with lease:
+            print(f'unit {lease.unit_id}: {len(lease.items)} scenes')
+            unit_results, unit_failures = run_scenes(process_scene, [tuple(scene) for scene in lease.items], **options)
+            results.update(unit_results)
+            for filename in unit_results:
+                failures.pop(filename, None)
+            failures.update(unit_failures)
+            if unit_failures:
+                # leaving the block without complete() releases the unit for another attempt
+                print(f'unit {lease.unit_id}: {len(unit_failures)} scenes failed, releasing it')
+                continue
+            lease.complete({'scenes': len(unit_results)})
+    print(', '.join(f'{count} units {state}' for state, count in sorted(queue.summary().items())))
+    return results, list(failures.items())
+
+@contextmanager
+def atomic_write(path):
+    """
+    Open a temporary file next to path for writing, and move it to path only once it is complete.
+
+    Readers see either the previous file or the whole new one, never a truncated archive, even
+    if the writer is killed. The temporary file is removed when writing fails.
+
+    :return: Binary file object, e.g. for np.savez / save_tiles
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def coarse_candidates(coarse_mask, height, width, h=512, w=512, min_sum=100):
+    """
+    Tiles of the sliding_crop grid that may pass a full-resolution sum test, judged from a
+    decimated mask.
+
+    Every coarse cell stands for a block of about height / coarse_height by width / coarse_width
+    full-resolution pixels. A tile's upper bound is the number of flagged cells touching its window
+    times the cell area, so no tile with more than min_sum flagged pixels is dropped as long as
+    coarse_mask flags every cell that contains at least one such pixel.
+
+    :param coarse_mask: 2-d 0/1 array, a decimated version of the full-resolution mask
+    :param height, width: Full-resolution scene size
+    :return: Tuple of two 1-d int arrays (rows, cols) of the candidate tiles, row-major
+    """
+    coarse_h, coarse_w = coarse_mask.shape
+    rows, cols = tile_grid(height, width, h, w)
+    if rows.size == 0:
+        return rows, cols
+    top = rows * coarse_h // height
+    left = cols * coarse_w // width
+    bottom = np.minimum(-(-(rows + h) * coarse_h // height), coarse_h)
+    right = np.minimum(-(-(cols + w) * coarse_w // width), coarse_w)
+    cell_area = -(-height // coarse_h) * -(-width // coarse_w)
+    bound = window_sums(coarse_mask, top, left, bottom, right) * cell_area
+    keep = bound > min_sum
+    return rows[keep], cols[keep]
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+
+# file name of the manifest inside the output directory, unless --manifest says otherwise
+MANIFEST_NAME = 'tiling_manifest.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    tool TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    params TEXT NOT NULL,
+    output TEXT NOT NULL,
+    output_size INTEGER,
+    tiles INTEGER,
+    updated_at REAL,
+    PRIMARY KEY (tool, filename)
+);
+'''
+
+
+def scene_fingerprint(path, use_hash=False, chunk_size=1024 * 1024):
+    """
+    Identify the content of a scene without tiling it again.
+
+    Size and modification time by default. With use_hash, a sha256 of the bytes, for shared
+    filesystems where mtimes are not trustworthy; zipped scenes (/vsizip/ paths) use the
+    member's CRC from the zip directory, which is free.
+
+    :return: String that changes whenever the scene does
+    """
+    if path.startswith('/vsizip/'):
+        zip_path, _, member = path[len('/vsizip/'):].partition('.zip/')
+        with zipfile.ZipFile(zip_path + '.zip') as zf:
+            info = zf.getinfo(member)
+        return f'zip:{info.file_size}:{info.CRC:08x}:{info.date_time}'
+    if use_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return 'sha256:' + digest.hexdigest()
+    stat = os.stat(path)
+    return f'stat:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class TilingManifest:
+    """SQLite record of every scene tiled by filter.py / filter_greyscale.py into an output directory.
+
+    Each row keeps the scene's fingerprint, the processing parameters and the output it produced,
+    so a rerun only tiles scenes that are new or changed, or whose parameters changed. Rows are
+    written by the parent process as each scene finishes, so a crash loses at most the scenes
+    that were still running.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # parameters are compared as canonical json, so dict order doesn't matter
+    @staticmethod
+    def encode_params(params):
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def is_current(self, tool, filename, fingerprint, params, output):
+        """True if filename was tiled from the same input with the same params and its output is intact."""
+        with self.lock:
+            row = self.conn.execute('''
+                SELECT fingerprint, params, output, output_size FROM scenes WHERE tool = ? AND filename = ?
+            ''', (tool, filename)).fetchone()
+        if row is None:
+            return False
+        old_fingerprint, old_params, old_output, output_size = row
+        return (old_fingerprint == fingerprint and old_params == self.encode_params(params)
+                and old_output == output and os.path.exists(output)
+                and (output_size is None or os.path.getsize(output) == output_size))
+
+    def record(self, tool, filename, fingerprint, params, output, tiles=None):
+        output_size = os.path.getsize(output) if os.path.exists(output) else None
+        with self.lock, self.conn:
+            self.conn.execute('''
+                INSERT INTO scenes (tool, filename, fingerprint, params, output, output_size, tiles, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (tool, filename) DO UPDATE SET
+                    fingerprint = excluded.fingerprint, params = excluded.params, output = excluded.output,
+                    output_size = excluded.output_size, tiles = excluded.tiles, updated_at = excluded.updated_at
+            ''', (tool, filename, fingerprint, self.encode_params(params), output, output_size, tiles, time.time()))
+
+
+def incremental_scenes(manifest, tool, scenes, output_dir, params_for, use_hash=False):
+    """
+    Drop the scenes whose output is current, and build the callback that records the rest.
+
+    :param manifest: TilingManifest of output_dir
+    :param tool: Name of the tiling script, so both scripts can share a manifest
+    :param scenes: List of (filename, path), e.g. from tiling.list_scenes
+    :param params_for: Function filename -> dict of every parameter that changes the output
+    :return: Tuple (scenes still to tile, on_done callback for tiling.run_scenes)
+    """
+    fingerprints = {filename: scene_fingerprint(path, use_hash) for filename, path in scenes}
+    params = {filename: params_for(filename) for filename, _ in scenes}
+
+    def output(filename):
+        return os.path.join(output_dir, os.path.splitext(filename)[0] + '.npz')
+
+    todo = [(filename, path) for filename, path in scenes
+            if not manifest.is_current(tool, filename, fingerprints[filename], params[filename], output(filename))]
+    print(f'{len(scenes) - len(todo)} of {len(scenes)} scenes are up to date, tiling {len(todo)}')
+
+    def on_done(filename, result):
+        # scenes that produced no archive (e.g. no centerline found) are tried again next time
+        if os.path.exists(output(filename)):
+            tiles = result if isinstance(result, int) and not isinstance(result, bool) else None
+            manifest.record(tool, filename, fingerprints[filename], params[filename], output(filename), tiles)
+    return todo, on_done
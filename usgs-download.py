@@ -3,74 +3,610 @@
 #  Python - JSON API
 #
 #  Script Last Modified: 6/17/2020
-#  Note: This example does not include any error handling!
-#        Any request can throw an error, which can be found in the errorCode proprty of
+#  Note: Any request can throw an error, which can be found in the errorCode proprty of
 #        the response (errorCode, errorMessage, and data properies are included in all responses).
-#        These types of checks could be done by writing a wrapper similiar to the sendRequest function below
+#        send_request turns these into M2MError exceptions and retries the transient ones
 #  Usage: python download_data.py -u username -p password
 # =============================================================================
 
 import json
+import random
+import shutil
 import requests
 import sys
 import time
 import argparse
 import os
-import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from scene_catalog import SceneCatalog, DOWNLOADED, FAILED, REQUESTED
+import work_queue
+import metrics
 
 failure_download = []
+# (filename, bytes, time to first byte, seconds) for every finished download
+transfer_log = []
+
+SERVICE_URL = "https://m2m.cr.usgs.gov/api/api/json/stable/"
+
+# what to order: dataset, area and dates of the search
+DATASET_NAME = "high_res_ortho"
+SPATIAL_FILTER = {'filterType': "mbr",
+                  'lowerLeft': {'latitude': 38.9829, 'longitude': -90.1607},
+                  'upperRight': {'latitude': 39.5241, 'longitude': -89.7031}}
+TEMPORAL_FILTER = {'start': '2000-3-1', 'end': '2016-1-1'}
+# I don't want to limit my results, but using the dataset-filters request, you can
+# find additional filters
+ACQUISITION_FILTER = {"end": "2015-4-1", "start": "2015-3-1"}
+# label of the download requests
+LABEL = "download-sample"
+
+# retry policy for idempotent API calls and downloads
+MAX_RETRIES = 5
+BACKOFF_BASE = 2
+MAX_BACKOFF = 120
+REQUEST_TIMEOUT = 300
+DOWNLOAD_TIMEOUT = 60
+# M2M endpoints that can be repeated without side effects
+IDEMPOTENT_ENDPOINTS = {'login', 'dataset-search', 'scene-search', 'download-options',
+                        'download-request', 'download-retrieve'}
+
+
+class M2MError(Exception):
+    """Error returned by the M2M API or raised while talking to it."""
+
+    def __init__(self, message, error_code=None, status_code=None):
+        super().__init__(message)
+        self.error_code = error_code
+        self.status_code = status_code
+
+
+class M2MAuthError(M2MError):
+    """Login failed, or the X-Auth-Token is invalid or expired."""
+
+
+class M2MTransientError(M2MError):
+    """Timeout, dropped connection, rate limit or 5xx; the call can be retried."""
+
+
+# one keep-alive connection pool shared by the API calls and the downloads
+session = requests.Session()
+
+# credentials and current X-Auth-Token, so an expired token can be refreshed
+auth = {}
+
+# size the connection pool for the number of concurrent downloads
+def configure_session(pool_size):
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+# full-jitter exponential backoff
+def backoff_sleep(attempt):
+    time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)))
+
+# parse the total size out of a "bytes start-end/total" Content-Range header
+def content_range_total(content_range):
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1]
+    return int(total) if total.isdigit() else None
+
+# fetch the rest of url into part_path, resuming from whatever is already there
+# returns the total size advertised by the server (None if unknown)
+def fetch_part(url, part_path, stats, chunk_size=1024 * 1024):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    request_start = time.time()
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+        stats.setdefault('ttfb', time.time() - request_start)
+        status = response.status_code
+        if status == 416 and offset:
+            total = content_range_total(response.headers.get('Content-Range'))
+            if total == offset:
+                # the previous run got every byte but died before the rename
+                return offset
+            # stale .part that no longer matches the remote file, start over
+            os.remove(part_path)
+            raise M2MTransientError(f'stale partial download ({offset} bytes, remote {total})', status_code=status)
+        if status == 429 or status >= 500:
+            raise M2MTransientError(f'HTTP {status}', status_code=status)
+        if status not in (200, 206):
+            raise M2MError(f'HTTP {status}', status_code=status)
+
+        if status == 206:
+            expected = content_range_total(response.headers.get('Content-Range'))
+            mode = 'ab'
+        else:
+            # server ignored the Range header, start over
+            length = response.headers.get('Content-Length')
+            expected = int(length) if length is not None else None
+            mode = 'wb'
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                stats['bytes'] += len(chunk)
+    return expected
+
+# download zip from url, streaming the body to <displayId>.zip.part in chunks
+# an existing .part file is resumed with an HTTP Range request, dropped connections are
+# retried with backoff, and the file is only renamed to <displayId>.zip once its size
+# matches what the server advertised
+# returns the number of bytes written so the caller can report throughput
+def download_file(url, filename, output_dir='.', chunk_size=1024 * 1024, verify_zip=False, retries=MAX_RETRIES):
+    filepath = os.path.join(output_dir, filename + '.zip')
+    part_path = filepath + '.part'
+    if os.path.exists(filepath):
+        print(f'{filename}.zip already downloaded, skipping')
+        return 0
+
+    stats = {'bytes': 0}
+    start = time.time()
+    for attempt in range(retries + 1):
+        try:
+            expected = fetch_part(url, part_path, stats, chunk_size)
+            size = os.path.getsize(part_path)
+            if expected is not None and size != expected:
+                raise M2MTransientError(f'incomplete ({size}/{expected} bytes)')
+            break
+        except (M2MTransientError, requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                failure_download.append(filename)
+                print(f'{filename} not successfully downloaded ({e}), {filename}.zip.part kept for resume')
+                return stats['bytes']
+            backoff_sleep(attempt)
+        except (M2MError, requests.RequestException, OSError) as e:
+            failure_download.append(filename)
+            print(f'{filename} not successfully downloaded ({e})')
+            return stats['bytes']
+
+    if verify_zip:
+        try:
+            with zipfile.ZipFile(part_path) as zf:
+                bad_member = zf.testzip()
+        except zipfile.BadZipFile:
+            bad_member = part_path
+        if bad_member is not None:
+            os.remove(part_path)
+            failure_download.append(filename)
+            print(f'{filename} failed checksum ({bad_member}), removed')
+            return stats['bytes']
+    os.replace(part_path, filepath)
+    transfer_log.append((filename, stats['bytes'], stats.get('ttfb'), time.time() - start))
+    print(f'successfully downloaded {filename}.zip')
+    return stats['bytes']
+
+# pull the GeoTIFF(s) out of a finished zip so tiling can start on them right away
+# members are streamed to a .part file and renamed, so a reader never sees half a tif
+def extract_tifs(zip_path, extract_dir, delete_zip=False, chunk_size=1024 * 1024):
+    extracted = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for member in zf.infolist():
+            if not member.filename.lower().endswith(('.tif', '.tiff')):
+                continue
+            target = os.path.join(extract_dir, os.path.basename(member.filename))
+            with zf.open(member) as src, open(target + '.part', 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+            os.replace(target + '.part', target)
+            extracted.append(target)
+    if delete_zip and extracted:
+        os.remove(zip_path)
+    return extracted
+
+# download one scene, optionally extract it, and record the outcome in the catalog
+# returns (bytes transferred, True if the scene was downloaded and extracted)
+def download_scene(download, output_dir, verify_zip=False, catalog=None, dataset=None,
+                   extract_dir=None, delete_zip=False):
+    with metrics.stage('transfer', scene=download['displayId']) as m:
+        nbytes = download_file(download['url'], download['displayId'], output_dir, verify_zip=verify_zip)
+        m['bytes_in'] = nbytes
+    filepath = os.path.join(output_dir, download['displayId'] + '.zip')
+    status = DOWNLOADED if os.path.exists(filepath) else FAILED
+    if status == DOWNLOADED and extract_dir is not None:
+        try:
+            with metrics.stage('extract', scene=download['displayId']) as m:
+                m['bytes_in'] = os.path.getsize(filepath)
+                extracted = extract_tifs(filepath, extract_dir, delete_zip)
+                m['bytes_out'] = sum(os.path.getsize(path) for path in extracted)
+            print(f'extracted {", ".join(os.path.basename(path) for path in extracted)}')
+            filepath = extracted[0] if extracted else filepath
+        except (zipfile.BadZipFile, OSError) as e:
+            status = FAILED
+            failure_download.append(download['displayId'])
+            print(f'{download["displayId"]} could not be extracted ({e})')
+    if catalog is not None:
+        catalog.record_download(dataset, download, status, path=filepath)
+    return nbytes, status == DOWNLOADED
+
+# hand a download to the worker pool, one request per file
+def submit_download(executor, futures, download, output_dir, **options):
+    print("DOWNLOAD: " + download['url'])
+    futures.append(executor.submit(download_scene, download, output_dir, **options))
+
+# (bytes, succeeded) of a finished download_scene future, a download that raised counts as failed
+def download_outcome(future):
+    try:
+        return future.result()
+    except Exception as e:
+        print(f'download raised {e!r}')
+        return 0, False
+
+# block until every submitted download is done and report aggregate throughput
+# returns the number of downloads that succeeded
+def wait_downloads(futures, start_time):
+    outcomes = [download_outcome(future) for future in futures]
+    total_bytes = sum(nbytes for nbytes, _ in outcomes)
+    succeeded = sum(ok for _, ok in outcomes)
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f'\nDownloaded {succeeded}/{len(futures)} files, '
+          f'{total_bytes / 1e6:.1f} MB in {elapsed:.1f} s '
+          f'({total_bytes / 1e6 / elapsed:.2f} MB/s, {len(futures) / elapsed:.2f} files/s)\n')
+    return succeeded
+
+class DownloadPoller:
+    """Hand prepared downloads to the worker pool as soon as download-retrieve lists them.
+
+    Outstanding download ids live in a dict keyed by id, so each retrieve call costs
+    time linear in its response. The wait between calls halves while new downloads keep
+    arriving and doubles while nothing changes. Downloads still preparing after max_wait
+    seconds are given up on and recorded in failure_download.
+    """
+
+    def __init__(self, service_url, label, api_key, submit, max_wait=4 * 3600, min_interval=5, max_interval=120):
+        self.service_url = service_url
+        self.label = label
+        self.api_key = api_key
+        self.submit = submit
+        self.max_wait = max_wait
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.pending = {}   # downloadId -> deadline
+        self.handed_out = set()
+        self.given_up = 0
+
+    # start waiting for these download ids
+    def add(self, download_ids):
+        deadline = time.time() + self.max_wait
+        for download_id in download_ids:
+            download_id = str(download_id)
+            if download_id not in self.handed_out:
+                self.pending.setdefault(download_id, deadline)
+
+    # submit a download that is already available, unless it was submitted before
+    def hand_out(self, download):
+        download_id = str(download['downloadId'])
+        if download_id in self.handed_out:
+            return False
+        self.pending.pop(download_id, None)
+        self.handed_out.add(download_id)
+        self.submit(download)
+        return True
+
+    # one download-retrieve call, returns how many downloads were handed out
+    def poll(self, include_requested=False):
+        retrieved = send_request(self.service_url + "download-retrieve", {'label': self.label}, self.api_key)
+        candidates = retrieved['available']
+        if include_requested:
+            candidates = candidates + retrieved['requested']
+        arrived = 0
+        for download in candidates:
+            if str(download['downloadId']) in self.pending and self.hand_out(download):
+                arrived += 1
+
+        now = time.time()
+        for download_id in [d for d, deadline in self.pending.items() if deadline < now]:
+            del self.pending[download_id]
+            self.given_up += 1
+            failure_download.append(f'downloadId {download_id}')
+            print(f'download {download_id} still preparing after {self.max_wait} s, giving up')
+        return arrived
+
+    # keep polling with adaptive backoff until nothing is pending
+    def run(self):
+        arrived = self.poll(include_requested=True)
+        while self.pending:
+            if arrived:
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 2)
+            print(f"\n{len(self.pending)} downloads are not available. Waiting for {self.interval:.0f} seconds.\n")
+            time.sleep(self.interval)
+            print("Trying to retrieve data\n")
+            arrived = self.poll()
+
+# yield scene-search result pages, following nextRecord until the search is exhausted
+def search_scenes(service_url, dataset_name, scene_filter, api_key, page_size=10000):
+    starting_number = 1
+    while True:
+        payload = {'datasetName': dataset_name,
+                   'maxResults': page_size,
+                   'startingNumber': starting_number,
+                   'sceneFilter': scene_filter}
+        with metrics.stage('search', start=starting_number) as m:
+            scenes = send_request(service_url + "scene-search", payload, api_key)
+            m['scenes'] = scenes['recordsReturned']
+        if scenes['recordsReturned'] == 0:
+            return
+        yield scenes['results']
+        next_record = scenes.get('nextRecord')
+        total_hits = scenes.get('totalHits')
+        if next_record is None or next_record <= starting_number or \
+                (total_hits is not None and next_record > total_hits):
+            return
+        starting_number = next_record
+
+# split an iterable into lists of at most n items
+def batched(iterable, n):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# one POST to the M2M API, raising a typed M2MError on any failure
+def post_request(url, data, api_key=None):
+    headers = {'X-Auth-Token': api_key} if api_key is not None else {}
+    try:
+        response = session.post(url, json.dumps(data), headers=headers, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise M2MTransientError(str(e)) from e
 
-# download zip from url 
-def download_file(url,filename, output_dir='.'):
-    response = requests.get(url, stream=True)
-    print(response.status_code)
-    if response.status_code == 200:
-        filename = filename + '.zip'
-        filepath = os.path.join(output_dir, filename)
-        urllib.request.urlretrieve(url, filepath)
-        print(f'successfully downloaded {filename}')
-    else:
-        failure_download.append(filename)
-        print(f'{filename} not successfully downloaded')
+    with response:
+        http_status_code = response.status_code
+        if http_status_code == 429 or http_status_code >= 500:
+            raise M2MTransientError(f'{http_status_code} from {url}', status_code=http_status_code)
+        try:
+            output = response.json()
+        except ValueError:
+            output = None
+        if output is not None and output.get('errorCode') is not None:
+            error_code = output['errorCode']
+            message = f"{error_code} - {output.get('errorMessage')}"
+            if error_code.startswith('AUTH_'):
+                raise M2MAuthError(message, error_code, http_status_code)
+            if error_code.startswith('RATE_LIMIT'):
+                raise M2MTransientError(message, error_code, http_status_code)
+            raise M2MError(message, error_code, http_status_code)
+        if http_status_code == 401:
+            raise M2MAuthError("401 Unauthorized", status_code=http_status_code)
+        if http_status_code == 404:
+            raise M2MError("404 Not Found", status_code=http_status_code)
+        if http_status_code >= 400 or output is None:
+            raise M2MError(f"Error Code {http_status_code}", status_code=http_status_code)
+    return output['data']
 
 # send http request
-def send_request(url, data, api_key=None):
-    json_data = json.dumps(data)
-
-    if api_key is None:
-        response = requests.post(url, json_data)
-    else:
-        headers = {'X-Auth-Token': api_key}
-        response = requests.post(url, json_data, headers=headers)
-
+# idempotent endpoints are retried with jittered exponential backoff, and an expired
+# X-Auth-Token is refreshed once by logging in again with the stored credentials
+def send_request(url, data, api_key=None, retries=MAX_RETRIES):
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    attempts = retries + 1 if endpoint in IDEMPOTENT_ENDPOINTS else 1
+    refreshed = False
+    attempt = 0
+    while True:
+        if api_key is not None and auth.get('api_key'):
+            api_key = auth['api_key']
+        try:
+            return post_request(url, data, api_key)
+        except M2MAuthError:
+            if refreshed or api_key is None or 'password' not in auth:
+                raise
+            print("API key rejected, logging in again\n")
+            refreshed = True
+            login(auth['service_url'], auth['username'], auth['password'])
+        except M2MTransientError as e:
+            attempt += 1
+            if attempt >= attempts:
+                raise
+            print(f"{endpoint} failed ({e}), retry {attempt}/{attempts - 1}")
+            backoff_sleep(attempt)
+
+# login and remember the credentials so send_request can refresh the token
+def login(service_url, username, password):
+    payload = {'username': username, 'password': password}
+    api_key = send_request(service_url + "login", payload)
+    auth.update(service_url=service_url, username=username, password=password, api_key=api_key)
+    return api_key
+# Logout so the API Key cannot be used anymore
+def logout(service_url, api_key):
+    endpoint = "logout"
     try:
-        http_status_code = response.status_code
-        if response is None:
-            print("No output from service")
-            sys.exit()
-        output = json.loads(response.text)
-        if output['errorCode'] is not None:
-            print(output['errorCode'], "- ", output['errorMessage'])
-            sys.exit()
-        if http_status_code == 404:
-            print("404 Not Found")
-            sys.exit()
-        elif http_status_code == 401:
-            print("401 Unauthorized")
-            sys.exit()
-        elif http_status_code == 400:
-            print("Error Code", http_status_code)
-            sys.exit()
-    except Exception as e:
-        response.close()
+        logged_out = send_request(service_url + endpoint, None, api_key) is None
+    except M2MError as e:
         print(e)
-        sys.exit()
-    response.close()
+        logged_out = False
+    if logged_out:
+        print("Logged Out\n\n")
+    else:
+        print("Logout Failed\n\n")
+    return logged_out
 
-    return output['data']
+# the datasets to download from, any other dataset the search finds is only logged
+def search_datasets(service_url, api_key, dataset_name=DATASET_NAME):
+    payload = {'datasetName': dataset_name,
+               'spatialFilter': SPATIAL_FILTER,
+               'temporalFilter': TEMPORAL_FILTER}
+
+    print("Searching datasets...\n")
+    datasets = send_request(service_url + "dataset-search", payload, api_key)
+    print("Found ", len(datasets), " datasets\n")
+
+    selected = []
+    for dataset in datasets:
+        # Because I've run this before I know that I want GLS_ALL, I don't want to download anything I don't
+        # want, so we will skip any other datasets that might be found, logging it incase I want to look into
+        # downloading that data in the future.
+        print(dataset['datasetAlias'])
+        if dataset['datasetAlias'] != dataset_name:
+            print("Found dataset " + dataset['collectionName'] + " but skipping it.\n")
+            continue
+        selected.append(dataset)
+    return selected
 
+# request downloads for entity_ids batch by batch, handing every download to poller.submit
+# as soon as it is available
+def request_scenes(service_url, api_key, dataset_name, entity_ids, poller, catalog, batch_size=5000):
+    for scene_ids in batched(entity_ids, batch_size):
+        # Find the download options for these scenes
+        payload = {'datasetName': dataset_name, 'entityIds': scene_ids}
 
-def main():
+        with metrics.stage('download-options') as m:
+            download_options = send_request(service_url + "download-options", payload, api_key)
+            m['scenes'] = len(scene_ids)
+        catalog.record_options(dataset_name, download_options)
+        # Aggregate a list of available products
+        downloads = []
+        for product in download_options:
+            # Make sure the product is available for this scene
+            if product['available']:
+                downloads.append({'entityId': product['entityId'],
+                                  'productId': product['id']})
+
+        # Did we find products?
+        if not downloads:
+            continue
+        payload = {'downloads': downloads,
+                   'label': poller.label}
+        # Call the download to get the direct download urls
+        with metrics.stage('download-request') as m:
+            request_results = send_request(service_url + "download-request", payload, api_key)
+            m['scenes'] = len(downloads)
+        catalog.set_status(dataset_name, [download['entityId'] for download in downloads], REQUESTED)
+        for failed in request_results['failed']:
+            catalog.set_status(dataset_name, [failed['entityId']], FAILED, failed.get('errorMessage'))
+        poller.add(request_results['newRecords'])
+        poller.add(request_results['duplicateProducts'])
+
+        # Get all available downloads
+        for download in request_results['availableDownloads']:
+            poller.hand_out(download)
+
+        # Start anything that finished preparing before requesting the next batch
+        if request_results['preparingDownloads'] and poller.pending:
+            poller.poll()
+
+# PreparingDownloads has a valid link that can be used but data may not be immediately available
+# Poll download-retrieve and start each download as soon as it is ready, the worker pool keeps
+# transferring in the meantime
+def wait_prepared(poller):
+    if poller.pending:
+        with metrics.stage('wait-prepared') as m:
+            m['scenes'] = len(poller.pending)
+            poller.run()
+    print("\nAll downloads are available to download.\n")
+
+# search one dataset and request its scenes batch by batch, handing every download to
+# poller.submit as soon as it is available; returns the number of scenes found
+def order_scenes(service_url, api_key, dataset, poller, catalog, page_size=10000, batch_size=5000,
+                 retry_failed=True, scene_filter=None):
+    dataset_name = dataset['datasetAlias']
+    if scene_filter is None:
+        scene_filter = {'spatialFilter': SPATIAL_FILTER,
+                        'acquisitionFilter': ACQUISITION_FILTER}
+
+    # Now I need to run a scene search to find data to download
+    # Pages are requested and downloaded as they arrive, so the 50,000 item limit of
+    # download-options only applies per batch and memory stays flat
+    print("Searching scenes...\n\n")
+    scenes_found = 0
+    for page in search_scenes(service_url, dataset_name, scene_filter, api_key, page_size):
+        scenes_found += len(page)
+        print(f"Found {scenes_found} scenes so far\n")
+        catalog.record_scenes(dataset_name, page)
+        # Skip scenes an earlier run already downloaded
+        entity_ids = catalog.pending(dataset_name, [result['entityId'] for result in page],
+                                     retry_failed=retry_failed)
+        request_scenes(service_url, api_key, dataset_name, entity_ids, poller, catalog, batch_size)
+
+    if scenes_found == 0:
+        print("Search found no results.\n")
+        return 0
+    wait_prepared(poller)
+    return scenes_found
+
+# sharded variant of order_scenes for several nodes sharing queue_dir: every node searches,
+# the first one to plan splits the scenes into work units, and each node then requests and
+# downloads only the units it leases (see work_queue.py); a unit is completed once all of its
+# transfers succeeded, otherwise its lease is released so it is retried, at most max_attempts
+# times. submit(download, futures) starts one download and appends its future.
+# returns the futures of this node's downloads
+def order_queued(service_url, api_key, dataset, queue_dir, submit, catalog, unit_size=50, lease_seconds=600,
+                 page_size=10000, batch_size=5000, retry_failed=True, max_wait=4 * 3600, min_interval=5,
+                 scene_filter=None):
+    dataset_name = dataset['datasetAlias']
+    if scene_filter is None:
+        scene_filter = {'spatialFilter': SPATIAL_FILTER,
+                        'acquisitionFilter': ACQUISITION_FILTER}
+    queue = work_queue.WorkQueue(os.path.join(queue_dir, dataset_name), lease_seconds)
+
+    # every node searches, so its own catalog knows all the scenes it may lease
+    print("Searching scenes...\n\n")
+    entity_ids = []
+    for page in search_scenes(service_url, dataset_name, scene_filter, api_key, page_size):
+        catalog.record_scenes(dataset_name, page)
+        entity_ids += [result['entityId'] for result in page]
+        print(f"Found {len(entity_ids)} scenes so far\n")
+    if not entity_ids:
+        print("Search found no results.\n")
+        return []
+    queue.plan(work_queue.split_units(entity_ids, unit_size))
+
+    all_futures = []
+    for lease in queue.leases():
+        with lease:
+            print(f"Unit {lease.unit_id}: {len(lease.items)} scenes\n")
+            futures = []
+            # a label per unit, so download-retrieve only lists this unit's downloads
+            poller = DownloadPoller(service_url, f'{LABEL}-{lease.unit_id}', api_key,
+                                    lambda download: submit(download, futures),
+                                    max_wait=max_wait, min_interval=min_interval)
+            entity_ids = catalog.pending(dataset_name, lease.items, retry_failed=retry_failed)
+            request_scenes(service_url, api_key, dataset_name, entity_ids, poller, catalog, batch_size)
+            wait_prepared(poller)
+            outcomes = [download_outcome(future) for future in futures]
+            all_futures += futures
+            failed = poller.given_up + sum(not ok for _, ok in outcomes)
+            if failed:
+                # leaving the block without complete() releases the unit for another attempt
+                print(f"Unit {lease.unit_id}: {failed} downloads failed, releasing it\n")
+                continue
+            lease.complete({'scenes': len(lease.items), 'downloads': len(futures),
+                            'downloaded': sum(ok for _, ok in outcomes),
+                            'bytes': sum(nbytes for nbytes, _ in outcomes)})
+    print(', '.join(f'{count} units {state}' for state, count in sorted(queue.summary().items())))
+    return all_futures
+
+# the search, ordering and download options, shared with pipeline.py
+def add_arguments(parser):
+    parser.add_argument('-u', '--username', required=True, help='Username')
+    parser.add_argument('-p', '--password', required=True, help='Password')
+    parser.add_argument('-o', '--output_dir', required=True, help='output directory')
+    parser.add_argument('--service_url', type=str, default=SERVICE_URL,
+                        help='M2M API base url, e.g. a local mock_m2m.py server')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of concurrent downloads')
+    parser.add_argument('--page_size', type=int, default=10000, help='scenes per scene-search page')
+    parser.add_argument('--batch_size', type=int, default=5000,
+                        help='scenes per download-options/download-request call')
+    parser.add_argument('--poll_interval', type=float, default=5,
+                        help='shortest wait between download-retrieve calls')
+    parser.add_argument('--max_wait', type=float, default=4 * 3600,
+                        help='seconds to wait for a preparing download before giving up on it')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='sqlite file recording scene/download state for incremental runs')
+    parser.add_argument('--skip_failed', action='store_true',
+                        help='with --catalog, do not retry scenes that failed in an earlier run')
+    parser.add_argument('--extract_dir', type=str, default=None,
+                        help='extract the GeoTIFF from each zip into this directory as soon as it is downloaded')
+    parser.add_argument('--verify_zip', action='store_true', help='check zip CRCs before marking a download complete')
+
+
+def main(argv=None):
     # NOTE :: Passing credentials over a command line argument is not considered secure
     #        and is used only for the purpose of being example - credential parameters
     #        should be gathered in a more secure way for production usage
@@ -78,163 +614,80 @@ def main():
 
     # user input
     parser = argparse.ArgumentParser()
-    parser.add_argument('-u', '--username', required=True, help='Username')
-    parser.add_argument('-p', '--password', required=True, help='Password')
-    parser.add_argument('-o', '--output_dir', required=True, help='output directory')
+    add_arguments(parser)
+    parser.add_argument('--delete_zip', action='store_true',
+                        help='with --extract_dir, remove each zip once its GeoTIFF is extracted')
+    work_queue.add_arguments(parser, 'scenes to download', unit_size=50)
+    metrics.add_arguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    metrics.configure_from_args(args)
 
     username = args.username
     password = args.password
     output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    if args.extract_dir is not None:
+        os.makedirs(args.extract_dir, exist_ok=True)
 
     print("\nRunning Scripts...\n")
 
-    service_url = "https://m2m.cr.usgs.gov/api/api/json/stable/"
+    service_url = args.service_url.rstrip("/") + "/"
 
-    # login
-    payload = {'username': username, 'password': password}
+    configure_session(args.workers + 2)
 
-    api_key = send_request(service_url + "login", payload)
+    # login
+    with metrics.stage('login'):
+        api_key = login(service_url, username, password)
 
     print("API Key: " + api_key + "\n")
 
-    dataset_name = "high_res_ortho"
+    dataset_name = DATASET_NAME
+    datasets = search_datasets(service_url, api_key)
 
-    spatial_filter = {'filterType': "mbr",
-                      'lowerLeft': {'latitude': 38.9829, 'longitude': -90.1607},
-                      'upperRight': {'latitude': 39.5241, 'longitude': -89.7031}}
+    # without --catalog the state only lives for this run
+    catalog = SceneCatalog(args.catalog or ':memory:')
 
-    temporal_filter = {'start': '2000-3-1', 'end': '2016-1-1'}
+    # downloads run in the background while we keep talking to the API
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    futures = []
+    start_time = time.time()
 
-    payload = {'datasetName': dataset_name,
-               'spatialFilter': spatial_filter,
-               'temporalFilter': temporal_filter}
-
-    print("Searching datasets...\n")
-    datasets = send_request(service_url + "dataset-search", payload, api_key)
-    print("Found ", len(datasets), " datasets\n")
+    def submit(download, futures=futures):
+        submit_download(executor, futures, download, output_dir,
+                        verify_zip=args.verify_zip, catalog=catalog,
+                        dataset=dataset_name,
+                        extract_dir=args.extract_dir,
+                        delete_zip=args.delete_zip)
 
     # download datasets
     for dataset in datasets:
-
-        # Because I've run this before I know that I want GLS_ALL, I don't want to download anything I don't
-        # want, so we will skip any other datasets that might be found, logging it incase I want to look into
-        # downloading that data in the future.
-        print(dataset['datasetAlias'])
-        if dataset['datasetAlias'] != dataset_name:
-            print("Found dataset " + dataset['collectionName'] + " but skipping it.\n")
+        if args.queue_dir:
+            futures += order_queued(service_url, api_key, dataset, args.queue_dir, submit, catalog,
+                                    args.unit_size, args.lease_seconds, args.page_size, args.batch_size,
+                                    retry_failed=not args.skip_failed, max_wait=args.max_wait,
+                                    min_interval=args.poll_interval)
             continue
+        poller = DownloadPoller(service_url, LABEL, api_key, submit,
+                                max_wait=args.max_wait, min_interval=args.poll_interval)
+        order_scenes(service_url, api_key, dataset, poller, catalog, args.page_size, args.batch_size,
+                     retry_failed=not args.skip_failed)
 
-        # I don't want to limit my results, but using the dataset-filters request, you can
-        # find additional filters
-
-        acquisition_filter = {"end": "2015-4-1", "start": "2015-3-1"}
-
-        payload = {'datasetName': dataset['datasetAlias'],
-                   'maxResults': 50000,
-                   'startingNumber': 1,
-                   'sceneFilter': {
-                       'spatialFilter': spatial_filter,
-                       'acquisitionFilter': acquisition_filter}}
-
-        # Now I need to run a scene search to find data to download
-        print("Searching scenes...\n\n")
-
-        scenes = send_request(service_url + "scene-search", payload, api_key)
-
-        # Did we find anything?
-        if scenes['recordsReturned'] > 0:
-            # Aggregate a list of scene ids
-            scene_ids = []
-            for result in scenes['results']:
-                # Add this scene to the list I would like to download
-                scene_ids.append(result['entityId'])
-
-            # Find the download options for these scenes
-            # NOTE :: Remember the scene list cannot exceed 50,000 items!
-            payload = {'datasetName': dataset['datasetAlias'], 'entityIds': scene_ids}
+    with metrics.stage('wait-transfers'):
+        wait_downloads(futures, start_time)
+    executor.shutdown()
+    for status, (count, size) in sorted(catalog.summary(dataset_name).items()):
+        print(f"{status}: {count} scenes, {size / 1e9:.2f} GB")
+    catalog.close()
 
-            download_options = send_request(service_url + "download-options", payload, api_key)
-            # Aggregate a list of available products
-            downloads = []
-            for product in download_options:
-                # Make sure the product is available for this scene
-                if product['available']:
-                    downloads.append({'entityId': product['entityId'],
-                                      'productId': product['id']})
-
-            # Did we find products?
-            if downloads:
-                requested_downloads_count = len(downloads)
-                # set a label for the download request
-                label = "download-sample"
-                payload = {'downloads': downloads,
-                           'label': label}
-                # Call the download to get the direct download urls
-                request_results = send_request(service_url + "download-request", payload, api_key)
-
-                # PreparingDownloads has a valid link that can be used but data may not be immediately available
-                # Call the download-retrieve method to get download that is available for immediate download
-                if request_results['preparingDownloads'] is not None and len(request_results['preparingDownloads']) > 0:
-                    payload = {'label': label}
-                    more_download_urls = send_request(service_url + "download-retrieve", payload, api_key)
-
-                    download_ids = []
-
-                    for download in more_download_urls['available']:
-                        if str(download['downloadId']) in request_results['newRecords'] or str(
-                                download['downloadId']) in \
-                                request_results['duplicateProducts']:
-                            download_ids.append(download['downloadId'])
-                            print("DOWNLOAD: " + download['url'])
-                            download_file(download['url'], download['displayId'], output_dir)
-
-                    for download in more_download_urls['requested']:
-                        if str(download['downloadId']) in request_results['newRecords'] or str(
-                                download['downloadId']) in \
-                                request_results['duplicateProducts']:
-                            download_ids.append(download['downloadId'])
-                            print("DOWNLOAD: " + download['url'])
-                            download_file(download['url'],download['displayId'], output_dir)
-
-                    # Didn't get all the requested downloads, call the download-retrieve method again probably
-                    # after 30 seconds
-                    while len(download_ids) < (requested_downloads_count - len(request_results['failed'])):
-                        preparing_downloads = requested_downloads_count - len(download_ids) - len(
-                            request_results['failed'])
-                        print("\n", preparing_downloads, "downloads are not available. Waiting for 30 seconds.\n")
-                        time.sleep(30)
-                        print("Trying to retrieve data\n")
-                        more_download_urls = send_request(service_url + "download-retrieve", payload, api_key)
-                        for download in more_download_urls['available']:
-                            if download['downloadId'] not in download_ids and (
-                                    str(download['downloadId']) in request_results['newRecords'] or str(
-                                download['downloadId']) in request_results['duplicateProducts']):
-                                download_ids.append(download['downloadId'])
-                                print("DOWNLOAD: " + download['url'])
-                                download_file(download['url'], download['displayId'], output_dir)
-
-
-                else:
-                    # Get all available downloads
-                    for download in request_results['availableDownloads']:
-                        # TODO :: Implement a downloading routine
-                        print("DOWNLOAD: " + download['url'])
-                        download_file(download['url'], download['displayId'], output_dir)
-                        print('# Get all available downloads')
-                        
-                print("\nAll downloads are available to download.\n")
-        else:
-            print("Search found no results.\n")
-
-    # Logout so the API Key cannot be used anymore
-    endpoint = "logout"
-    if send_request(service_url + endpoint, None, api_key) is None:
-        print("Logged Out\n\n")
-    else:
-        print("Logout Failed\n\n")
+    logout(service_url, api_key)
+    metrics.finish()
 
 if __name__ == '__main__':
-    main()
-    print(failure_download)
+    try:
+        main()
+    except M2MError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        print(failure_download)
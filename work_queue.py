@@ -0,0 +1,293 @@
+# Work units shared by several nodes through a directory on a shared filesystem.
+#
+#   queue = WorkQueue('/shared/queue', lease_seconds=600)
+#   queue.plan(split_units(scenes, 10))
+#   for lease in queue.leases():
+#       with lease:
+#           ...  # process lease.items
+#           lease.complete({'tiles': n})
+#
+# Layout of the queue directory:
+#   units.json          every unit id and its items, written once by whichever node plans first
+#   leases/<unit>.<n>   the n-th claim of a unit, its mtime is the holder's heartbeat
+#   done/<unit>         completion record, written at most once per unit
+#
+# Every file is published by writing a temporary file and hard-linking it to its final name.
+# The link fails if the name exists, so when several nodes race for the same name exactly one
+# wins, and nobody ever reads a half-written file. NFS (v3 and later), Lustre and GPFS all
+# provide this, so no broker or database server is needed (SQLite locking is not reliable on
+# NFS, which is why the queue is not a database).
+#
+# A lease stays alive while its holder keeps touching it. When a node is killed the touching
+# stops, and once the lease is older than lease_seconds the next claimer creates the following
+# generation and redoes the unit. A node that was only slow may finish the same unit as well.
+# The done record is still written once, and the scripts write their outputs (zips, npz
+# archives) atomically and skip existing ones, so a duplicate costs time but not correctness.
+# The nodes' clocks should agree to well within lease_seconds.
+
+import argparse
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import Counter
+
+PLAN_NAME = 'units.json'
+# states of a unit, see WorkQueue.state
+PENDING = 'pending'
+LEASED = 'leased'
+EXPIRED = 'expired'
+EXHAUSTED = 'exhausted'
+DONE = 'done'
+
+
+def split_units(items, unit_size):
+    """
+    Cut a list into consecutive work units.
+
+    :return: Dict unit id -> list of at most unit_size items, ids sort in list order
+    """
+    return {f'{k:06d}': items[start:start + unit_size]
+            for k, start in enumerate(range(0, len(items), unit_size))}
+
+
+def publish(path, data):
+    """
+    Create path holding data as json, atomically and only if it does not exist yet.
+
+    :return: True if this call created the file, False if it already existed
+    """
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+class Lease:
+    """One node's claim on a work unit.
+
+    Use it as a context manager: a background thread touches the lease file every third of
+    lease_seconds while the block runs. Leaving the block without complete() (e.g. on an
+    exception) releases the unit at once, so another node can retry it without waiting for
+    the lease to expire.
+    """
+
+    def __init__(self, queue, unit_id, generation, items):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.generation = generation
+        self.items = items
+        self.path = queue.lease_path(unit_id, generation)
+        self.completed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def lost(self):
+        """True once another node has taken the unit over after this lease expired."""
+        return os.path.exists(self.queue.lease_path(self.unit_id, self.generation + 1))
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if self.lost:
+                print(f'lease on unit {self.unit_id} expired and was taken over by another node')
+                return
+            try:
+                os.utime(self.path)
+            except OSError as e:
+                print(f'could not renew lease on unit {self.unit_id} ({e})')
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        if not self.completed:
+            self.release()
+        return False
+
+    def complete(self, result=None):
+        """
+        Record the unit as done.
+
+        :param result: Json-serialisable summary kept in the done record
+        :return: True if this node recorded it, False if another node completed it first
+        """
+        self.completed = True
+        record = {'owner': self.queue.owner, 'generation': self.generation, 'time': time.time(), 'result': result}
+        return publish(self.queue.done_path(self.unit_id), record)
+
+    def release(self):
+        # an mtime of 0 reads as long expired
+        try:
+            os.utime(self.path, (0, 0))
+        except OSError as e:
+            print(f'could not release unit {self.unit_id} ({e})')
+
+
+class WorkQueue:
+    """Lease-based work queue in a directory that every node can reach.
+
+    :param queue_dir: Shared directory of the queue, created if missing
+    :param lease_seconds: A lease not renewed for this long is reclaimed by the next claimer
+    :param max_attempts: Claims per unit before it is given up on as exhausted
+    :param owner: Name of this node in lease and done records, default host:pid
+    """
+
+    def __init__(self, queue_dir, lease_seconds=600, max_attempts=3, owner=None):
+        self.queue_dir = queue_dir
+        self.lease_dir = os.path.join(queue_dir, 'leases')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.units = self.load_plan()
+
+    def lease_path(self, unit_id, generation):
+        return os.path.join(self.lease_dir, f'{unit_id}.{generation}')
+
+    def done_path(self, unit_id):
+        return os.path.join(self.done_dir, unit_id)
+
+    def load_plan(self):
+        path = os.path.join(self.queue_dir, PLAN_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def plan(self, units):
+        """
+        Publish the work units, unless another node already planned this queue.
+
+        Every node can call this with its own listing; the first plan wins and the others
+        work from it, so all nodes agree on the units even if their listings differ.
+
+        :param units: Dict unit id -> list of json-serialisable items, e.g. from split_units
+        :return: The plan in effect
+        """
+        if publish(os.path.join(self.queue_dir, PLAN_NAME), units):
+            print(f'planned {len(units)} work units in {self.queue_dir}')
+        self.units = self.load_plan()
+        if self.units != json.loads(json.dumps(units)):
+            print(f'{self.queue_dir} was planned from a different list, working from the existing plan')
+        return self.units
+
+    def _scan(self):
+        # latest claim generation of every claimed unit, and the units that are done
+        generations = {}
+        for name in os.listdir(self.lease_dir):
+            unit_id, _, generation = name.rpartition('.')
+            if generation.isdigit():
+                generations[unit_id] = max(generations.get(unit_id, 0), int(generation))
+        done = {name for name in os.listdir(self.done_dir) if not name.endswith('.tmp')}
+        return generations, done
+
+    def _expired(self, unit_id, generation, now):
+        try:
+            return os.stat(self.lease_path(unit_id, generation)).st_mtime + self.lease_seconds < now
+        except FileNotFoundError:
+            return True
+
+    def state(self):
+        """Dict unit id -> PENDING, LEASED, EXPIRED, EXHAUSTED or DONE."""
+        generations, done = self._scan()
+        now = time.time()
+        states = {}
+        for unit_id in self.units:
+            if unit_id in done:
+                states[unit_id] = DONE
+            elif unit_id not in generations:
+                states[unit_id] = PENDING
+            elif not self._expired(unit_id, generations[unit_id], now):
+                states[unit_id] = LEASED
+            elif generations[unit_id] >= self.max_attempts:
+                states[unit_id] = EXHAUSTED
+            else:
+                states[unit_id] = EXPIRED
+        return states
+
+    def claim(self):
+        """
+        Lease one pending or expired unit.
+
+        :return: Lease, or None if no unit can be claimed right now
+        """
+        generations, _ = self._scan()
+        candidates = [unit_id for unit_id, state in self.state().items() if state in (PENDING, EXPIRED)]
+        # nodes try the units in different orders, so they rarely race for the same one
+        random.shuffle(candidates)
+        for unit_id in candidates:
+            generation = generations.get(unit_id, 0) + 1
+            if not publish(self.lease_path(unit_id, generation), {'owner': self.owner, 'time': time.time()}):
+                continue
+            lease = Lease(self, unit_id, generation, self.units[unit_id])
+            # completed by the previous holder between the scan and the claim
+            if os.path.exists(self.done_path(unit_id)):
+                lease.release()
+                continue
+            return lease
+        return None
+
+    def leases(self, poll=None):
+        """
+        Yield leases until every unit is done or exhausted.
+
+        While the remaining units are all leased by other nodes this waits and polls again
+        instead of returning, so the units of a node that dies are picked up once they expire.
+
+        :param poll: Seconds between polls, default a quarter of lease_seconds (at most 10)
+        """
+        poll = poll or min(10, self.lease_seconds / 4)
+        while True:
+            lease = self.claim()
+            if lease is not None:
+                yield lease
+                continue
+            counts = Counter(self.state().values())
+            if not counts[PENDING] + counts[LEASED] + counts[EXPIRED]:
+                if counts[EXHAUSTED]:
+                    print(f'{counts[EXHAUSTED]} units failed {self.max_attempts} times and were given up on')
+                return
+            time.sleep(poll)
+
+    def summary(self):
+        """Count of units per state."""
+        return Counter(self.state().values())
+
+
+def add_arguments(parser, item='scenes', unit_size=10):
+    """Add the --queue_dir, --unit_size and --lease_seconds options to an argparse parser."""
+    parser.add_argument('--queue_dir', type=str, default=None,
+                        help=f'share the {item} with other nodes as work units leased from this shared directory')
+    parser.add_argument('--unit_size', type=int, default=unit_size, help=f'{item} per work unit of --queue_dir')
+    parser.add_argument('--lease_seconds', type=float, default=600,
+                        help='a node that has not renewed its lease for this long is presumed dead')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the state of a work queue directory')
+    parser.add_argument('queue_dir', type=str)
+    parser.add_argument('--lease_seconds', type=float, default=600)
+    parser.add_argument('--max_attempts', type=int, default=3)
+    args = parser.parse_args()
+    queue = WorkQueue(args.queue_dir, args.lease_seconds, args.max_attempts)
+    if queue.units is None:
+        parser.error(f'{args.queue_dir} has not been planned yet')
+    for state, count in sorted(queue.summary().items()):
+        print(f'{state}: {count} units')